@@ -1,15 +1,21 @@
+import os
 import datetime
 import json
 import asyncio
 import logging
 from logging.handlers import RotatingFileHandler
 from sys import stdout
-from maj.identifier import Identifier
+from maj.identifier import Identifier, AcrQuota
 from maj.twitchrecorder import TwitchRecorder
 from maj.songlist import SongList
+from maj.archive import SetlistArchive
 from maj.vpnrotator import VpnRotator
 from maj.twitchbot import TwitchBot
 from maj.utils.botreplys import load_chat_intents, get_reply_based_on_message
+from maj.utils.audio import SamplePreprocessor
+from maj.transitions import TransitionDetector
+from maj.fingerprint import FingerprintCache
+from maj.scheduler import AdaptiveSchedule, DemandTracker
 
 config = {}
 
@@ -36,27 +42,107 @@ logger.addHandler(consoleHandler)
 vpn = VpnRotator(config['vpnConfigFolders'], config['vpnUserPwdConfigPath'])
 
 # set up list to cache songs (will load from file if exists)
-playlist = SongList(config['recordedSavePath'], config['channel'], datetime.datetime.today())
+# optional sqlite archive of every setlist used as the backing store of the playlist
+archive = None
+archive_config = config.get('setlistArchive', {})
+if archive_config.get('enabled', False):
+    archive = SetlistArchive(os.path.join(config['recordedSavePath'], archive_config.get('filename', 'setlists.db')),
+                             journal_mode=archive_config.get('journalMode', 'DELETE'))
+
+journal_config = config.get('setlistJournal', {})
+playlist = SongList(config['recordedSavePath'], config['channel'], datetime.datetime.today(),
+                    use_journal=journal_config.get('enabled', False), compact_seconds=journal_config.get('compactSeconds', 600),
+                    write_behind_seconds=config.get('setlistWriteBehindSeconds', 0), archive=archive)
 
 # set up recorder
-twitch_recorder = TwitchRecorder(config['botClientID'], config['botSecret'], config['channel'], config['recordedSavePath'])
+twitch_recorder = TwitchRecorder(config['botClientID'], config['botSecret'], config['channel'], config['recordedSavePath'], buffer_seconds=config.get('bufferSeconds', 0), url_cache_seconds=config.get('streamUrlCacheSeconds', 0), store_options=config.get('sampleStore', {}), status_cache_seconds=config.get('statusCacheSeconds', 60))
+
+if 0 < config.get('bufferSeconds', 0) < config.get('recordLength', 15):
+    logger.warning(f"bufferSeconds ({config['bufferSeconds']}) is less than recordLength so the stream buffer will never be used")
+
+# set up optional cache of ACR results keyed by audio fingerprint
+fingerprint_cache = None
+fingerprint_config = config.get('fingerprintCache', {})
+if fingerprint_config.get('enabled', False):
+    fingerprint_cache = FingerprintCache(os.path.join(config['recordedSavePath'], 'fingerprints.json'),
+                                         similarity=fingerprint_config.get('similarity', 0.3),
+                                         max_entries=fingerprint_config.get('maxEntries', 500),
+                                         max_age_hours=fingerprint_config.get('maxAgeHours', 24))
+
+# set up optional budget of requests sent to ACR
+acr_quota = None
+quota_config = config.get('acrQuota', {})
+if quota_config.get('enabled', False):
+    acr_quota = AcrQuota(os.path.join(config['recordedSavePath'], 'acr_quota.json'),
+                         per_minute=quota_config.get('perMinute', 0),
+                         per_hour=quota_config.get('perHour', 0),
+                         per_month=quota_config.get('perMonth', 0),
+                         background_reserve=quota_config.get('backgroundReserve', 0.2))
 
 # set up music identifier
-music_identifier = Identifier(config['acrKey'], config['acrSecret'], config['acrHostUrl'])
+music_identifier = Identifier(config['acrKey'], config['acrSecret'], config['acrHostUrl'], fingerprint_cache=fingerprint_cache,
+                              endpoints=config.get('acrEndpoints', []), hedge_delay=config.get('acrHedgeDelay', 3.0), quota=acr_quota)
+
+# set up optional step to shrink samples before sending to ACR
+preprocessor = None
+preprocess_config = config.get('preprocess', {})
+if preprocess_config.get('enabled', False):
+    preprocessor = SamplePreprocessor(sample_rate=preprocess_config.get('sampleRate', 8000),
+                                      max_seconds=preprocess_config.get('maxSeconds', 12),
+                                      skip_seconds=preprocess_config.get('skipSeconds', 0),
+                                      trim_silence=preprocess_config.get('trimSilence', True),
+                                      silence_db=preprocess_config.get('silenceThresholdDb', -45),
+                                      codec=preprocess_config.get('codec', 'opus'))
+
+# set up optional detector so auto-id only calls ACR when the song seems to change
+transition_detector = None
+transition_config = config.get('transitionDetection', {})
+if transition_config.get('enabled', False):
+    transition_detector = TransitionDetector(threshold=transition_config.get('threshold', 0.2),
+                                             silence_db=transition_config.get('silenceThresholdDb', -45),
+                                             max_interval=transition_config.get('maxIntervalSeconds', 300))
+
+# set up optional schedule so auto-id waits based on when the current song should end
+schedule = None
+schedule_config = config.get('adaptiveSchedule', {})
+if schedule_config.get('enabled', False):
+    schedule = AdaptiveSchedule(config.get('identifyCooldown', 30),
+                                lead_seconds=schedule_config.get('leadSeconds', 15),
+                                dense_interval=schedule_config.get('denseIntervalSeconds', 10),
+                                dense_window=schedule_config.get('denseWindowSeconds', 90),
+                                max_sleep=schedule_config.get('maxSleepSeconds', 600))
+
+# set up optional tracking of chat asking for the song to identify early / less often when quiet
+demand = None
+demand_config = config.get('chatDemand', {})
+if demand_config.get('enabled', False):
+    demand = DemandTracker(window=demand_config.get('windowSeconds', 60),
+                           threshold=demand_config.get('threshold', 3),
+                           retrigger_seconds=demand_config.get('retriggerSeconds', 60),
+                           quiet_seconds=demand_config.get('quietSeconds', 300),
+                           quiet_factor=demand_config.get('quietFactor', 2.0))
 
 bot = None
 
 async def identify_on_interval():
-    while True:
-        if bot is None or bot.is_identifying:
-            continue
+    while bot is None:
+        await asyncio.sleep(1)
 
+    while True:
         try:
-            await bot.try_identify()
+            # shares the identification when a !track is already identifying
+            await bot.auto_identify()
             logger.info('cooling down until next check ...')
-            await asyncio.sleep(config.get("identifyCooldown", 30))
+
+            cooldown = schedule.next_delay() if schedule is not None else config.get("identifyCooldown", 30)
+            if acr_quota is not None:
+                cooldown = acr_quota.stretch_interval(cooldown) # check less often when running out of budget
+            if demand is not None:
+                cooldown = demand.stretch_interval(cooldown) # check less often when nobody is asking
+            await bot.identify_scheduler.cooldown(cooldown)
         except Exception as e:
             logger.error(f"identify_on_interval error: {e}")
+            await asyncio.sleep(config.get("identifyCooldown", 30))
 
 async def run_bot():
     global bot
@@ -68,6 +154,10 @@ async def run_bot():
             recorder=twitch_recorder,
             identifier=music_identifier,
             vpn=vpn,
+            preprocessor=preprocessor,
+            transition_detector=transition_detector,
+            schedule=schedule,
+            demand=demand,
             irc_token=config['botIrcToken'],
             client_id=config['botClientID'],
             nick=config['botUsername'],
@@ -89,7 +179,7 @@ async def run_bot():
 
         # get title of the stream
         if playlist.stream_title is None or len(playlist.stream_title) == 0:
-            playlist.stream_title = twitch_recorder.get_stream_title()
+            playlist.stream_title = await twitch_recorder.get_stream_title()
 
         logger.info('waiting for channel to be offline ...')
         while True:
@@ -98,10 +188,11 @@ async def run_bot():
                 last_checked_seconds = (datetime.datetime.now() - last_checked).total_seconds()
                 if last_checked_seconds > 600:
                     last_checked = datetime.datetime.today()
-                    if not bot.twitch_recorder.is_user_online() and offline_time is None:
+                    is_online = await bot.twitch_recorder.is_user_online()
+                    if not is_online and offline_time is None:
                         logger.warning("twitch channel appears offline")
                         offline_time = datetime.datetime.today()
-                    elif bot.twitch_recorder.is_user_online():
+                    elif is_online:
                         offline_time = None
 
                     if offline_time is not None:
@@ -157,7 +248,7 @@ async def shutdown(loop):
 async def main():
     load_chat_intents('./maj/utils/intents.json')
 
-    token_updated = twitch_recorder.authorize(config['botToken']['oauthToken'], config['botToken']['expirationDate'])    
+    token_updated = await twitch_recorder.authorize(config['botToken']['oauthToken'], config['botToken']['expirationDate'])    
 
     # save new oauth token if fetched new one
     if token_updated:
@@ -168,7 +259,7 @@ async def main():
             f.write(json.dumps(config, indent = 4))
 
     try:
-        while not twitch_recorder.is_user_online() and not config.get('enabledOffline', False):
+        while not await twitch_recorder.is_user_online() and not config.get('enabledOffline', False):
             logger.info('waiting for channel to be online ...')
             await asyncio.sleep(60)
     except Exception as e:
@@ -179,6 +270,13 @@ async def main():
         playlist.setlist_start = datetime.datetime.today()
         playlist.has_started = True
 
+    if acr_quota is not None:
+        acr_quota.setlist_date = playlist.setlist_start.strftime('%Y-%m-%d')
+
+    # keep the last few seconds of the stream in memory so !track can sample instantly
+    if twitch_recorder.start_buffer():
+        logger.info('buffering stream in memory ...')
+
     # have twitch bot run in another task
     try:
         bot_task = asyncio.create_task(run_bot())
@@ -192,6 +290,18 @@ async def main():
     except Exception as e:
         logger.warning(f"bot_task ex thrown: {e}")
 
+    twitch_recorder.stop_buffer()
+    playlist.close() # write pending changes and fold the journal into the setlist json file
+
+    if archive is not None:
+        archive.close()
+    await twitch_recorder.close()
+    await music_identifier.close()
+
+    if acr_quota is not None:
+        logger.info(f"acr requests per setlist: {acr_quota.report()}")
+        acr_quota.close() # write the counters still pending
+
     if vpn is not None and vpn.is_connected:
         logger.info("vpn disconnected ...")
         vpn.disconnect()
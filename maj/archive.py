@@ -0,0 +1,300 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import datetime
+import threading
+import logging
+from maj.songlist import get_song_key
+
+log = logging.getLogger(__name__)
+
+SETLIST_FILE_PATTERN = re.compile(r'^(\d{4}-\d{2}-\d{2})\.json$')
+JOURNAL_MODES = ["DELETE", "TRUNCATE", "PERSIST", "WAL"] # WAL only works when the database is on a local disk
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS streams (
+    id INTEGER PRIMARY KEY,
+    channel TEXT NOT NULL,
+    date TEXT NOT NULL,
+    setlist_start TEXT,
+    has_started INTEGER NOT NULL DEFAULT 0,
+    stream_title TEXT NOT NULL DEFAULT '',
+    UNIQUE (channel, date)
+);
+CREATE TABLE IF NOT EXISTS submitters (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,
+    stream_id INTEGER NOT NULL REFERENCES streams(id) ON DELETE CASCADE,
+    title TEXT NOT NULL,
+    norm_title TEXT NOT NULL,
+    artists TEXT NOT NULL,
+    album TEXT NOT NULL DEFAULT '',
+    duration_s REAL NOT NULL DEFAULT 0,
+    timestamp TEXT NOT NULL,
+    last_timestamp TEXT NOT NULL,
+    submitter_id INTEGER REFERENCES submitters(id),
+    was_found INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS song_artists (
+    song_id INTEGER NOT NULL REFERENCES songs(id) ON DELETE CASCADE,
+    norm_artist TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS songs_norm_title ON songs (norm_title);
+CREATE INDEX IF NOT EXISTS songs_timestamp ON songs (timestamp);
+CREATE INDEX IF NOT EXISTS songs_submitter ON songs (submitter_id);
+CREATE INDEX IF NOT EXISTS songs_stream ON songs (stream_id, timestamp);
+CREATE INDEX IF NOT EXISTS song_artists_norm_artist ON song_artists (norm_artist);
+CREATE INDEX IF NOT EXISTS song_artists_song ON song_artists (song_id);
+"""
+
+
+def normalize_artist(artist):
+    return artist.strip().lower()
+
+
+class SetlistArchive:
+    """
+    SQLite archive of the setlists of every stream (songs, streams and who added them) so
+    questions across streams do not have to open every setlist json file.
+    """
+
+    def __init__(self, path, journal_mode="DELETE"):
+        self.path = path
+        journal_mode = journal_mode.upper()
+        if journal_mode not in JOURNAL_MODES:
+            raise ValueError(f"unknown sqlite journal mode '{journal_mode}' (expected one of {JOURNAL_MODES})")
+        self.lock = threading.Lock() # the connection is shared with the setlist write behind thread
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.execute(f"PRAGMA journal_mode = {journal_mode}")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get_stream_id(self, channel, date, create=True):
+        row = self.conn.execute("SELECT id FROM streams WHERE channel = ? AND date = ?", (channel, date)).fetchone()
+        if row is not None:
+            return row['id']
+        if not create:
+            return None
+        return self.conn.execute("INSERT INTO streams (channel, date) VALUES (?, ?)", (channel, date)).lastrowid
+
+    def get_submitter_id(self, name):
+        if name is None or name == "":
+            return None # added by the bot
+
+        self.conn.execute("INSERT OR IGNORE INTO submitters (name) VALUES (?)", (name,))
+        return self.conn.execute("SELECT id FROM submitters WHERE name = ?", (name,)).fetchone()['id']
+
+    def update_stream(self, stream_id, setlist):
+        self.conn.execute("UPDATE streams SET setlist_start = ?, has_started = ?, stream_title = ? WHERE id = ?",
+                          (setlist.get('setlist_start'), int(setlist.get('has_started', False)), setlist.get('stream_title', '') or '', stream_id))
+
+    def find_song_id(self, stream_id, ref):
+        # same title, artists and first identification as the song referenced by a setlist change
+        rows = self.conn.execute("SELECT id, title, artists FROM songs WHERE stream_id = ? AND timestamp = ?", (stream_id, ref['timestamp']))
+        key = get_song_key(ref['title'], ref['artists'])
+        for row in rows:
+            if get_song_key(row['title'], json.loads(row['artists'])) == key:
+                return row['id']
+        return None
+
+    def insert_song(self, stream_id, song):
+        song_id = self.conn.execute(
+            "INSERT INTO songs (stream_id, title, norm_title, artists, album, duration_s, timestamp, last_timestamp, submitter_id, was_found) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (stream_id, song['title'], get_song_key(song['title'], [])[0], json.dumps(song['artists']), song.get('album', '') or '',
+             song.get('duration_s', 0) or 0, song['timestamp'], song.get('last_timestamp') or song['timestamp'],
+             self.get_submitter_id(song.get('added_by', '')), int(song.get('was_found', False)))).lastrowid
+
+        self.conn.executemany("INSERT INTO song_artists (song_id, norm_artist) VALUES (?, ?)",
+                              [(song_id, normalize_artist(a)) for a in song['artists']])
+        return song_id
+
+    def save_setlist(self, channel, date, setlist):
+        """
+        Replaces the stream's songs with the setlist (same dict as the setlist json file).
+        """
+        with self.lock, self.conn:
+            stream_id = self.get_stream_id(channel, date)
+            self.update_stream(stream_id, setlist)
+            self.conn.execute("DELETE FROM songs WHERE stream_id = ?", (stream_id,))
+            for song in setlist.get('songs', []):
+                self.insert_song(stream_id, song)
+
+    def apply_records(self, channel, date, records, setlist=None):
+        """
+        Applies setlist changes (SongList journal records) in one transaction. setlist is the
+        setlist json without songs and is used to keep the stream info up to date.
+        """
+        with self.lock, self.conn:
+            stream_id = self.get_stream_id(channel, date)
+            if setlist is not None:
+                self.update_stream(stream_id, setlist)
+
+            for record in records:
+                op = record.get('op')
+                if op == 'add':
+                    if self.find_song_id(stream_id, record['song']) is None:
+                        self.insert_song(stream_id, record['song'])
+                elif op == 'touch':
+                    song_id = self.find_song_id(stream_id, record)
+                    if song_id is not None:
+                        self.conn.execute("UPDATE songs SET last_timestamp = ? WHERE id = ?", (record['last_timestamp'], song_id))
+                elif op == 'remove':
+                    song_id = self.find_song_id(stream_id, record)
+                    if song_id is not None:
+                        self.conn.execute("DELETE FROM songs WHERE id = ?", (song_id,))
+
+    def load_setlist(self, channel, date):
+        """
+        Returns the setlist in the same format as the setlist json file (or None if not archived).
+        """
+        with self.lock:
+            stream = self.conn.execute("SELECT * FROM streams WHERE channel = ? AND date = ?", (channel, date)).fetchone()
+            if stream is None:
+                return None
+
+            rows = self.conn.execute("SELECT s.*, COALESCE(u.name, '') AS added_by FROM songs s LEFT JOIN submitters u ON u.id = s.submitter_id "
+                                     "WHERE s.stream_id = ? ORDER BY s.timestamp, s.id", (stream['id'],)).fetchall()
+
+        return {'setlist_start': stream['setlist_start'],
+                'has_started': bool(stream['has_started']),
+                'stream_title': stream['stream_title'],
+                'songs': [{'title': r['title'],
+                           'album': r['album'],
+                           'artists': json.loads(r['artists']),
+                           'duration_s': r['duration_s'],
+                           'timestamp': r['timestamp'],
+                           'last_timestamp': r['last_timestamp'],
+                           'added_by': r['added_by'],
+                           'was_found': bool(r['was_found'])} for r in rows]}
+
+    def import_json_files(self, setlists_path, channel=None):
+        """
+        Imports setlist json files (<channel>/YYYY-MM-DD.json). When channel is None every
+        sub directory of setlists_path is imported as a channel. Returns the number of setlists.
+        """
+        if channel is None:
+            channels = [c for c in sorted(os.listdir(setlists_path)) if os.path.isdir(os.path.join(setlists_path, c))]
+            return sum(self.import_json_files(os.path.join(setlists_path, c), c) for c in channels)
+
+        count = 0
+        for filename in sorted(os.listdir(setlists_path)):
+            m = SETLIST_FILE_PATTERN.match(filename)
+            if m is None:
+                continue # not a setlist (journal, csv, tmp file ...)
+
+            try:
+                with open(os.path.join(setlists_path, filename), 'r') as f:
+                    setlist = json.load(f)
+            except Exception as e:
+                log.error(f"could not import {filename}: {e}")
+                continue
+
+            self.save_setlist(channel, m.group(1), setlist)
+            count += 1
+
+        log.info(f"imported {count} setlists of {channel}")
+        return count
+
+    def get_song_history(self, title, artist=None, channel=None):
+        """
+        Every time the song was played (newest first) as dicts of channel, date and timestamp.
+        """
+        query = "SELECT st.channel, st.date, s.title, s.artists, s.timestamp, COALESCE(u.name, '') AS added_by FROM songs s " \
+                "JOIN streams st ON st.id = s.stream_id LEFT JOIN submitters u ON u.id = s.submitter_id WHERE s.norm_title = ?"
+        params = [get_song_key(title, [])[0]]
+
+        if artist is not None:
+            query += " AND s.id IN (SELECT song_id FROM song_artists WHERE norm_artist = ?)"
+            params.append(normalize_artist(artist))
+        if channel is not None:
+            query += " AND st.channel = ?"
+            params.append(channel)
+
+        with self.lock:
+            rows = self.conn.execute(query + " ORDER BY s.timestamp DESC", params).fetchall()
+        return [dict(r, artists=json.loads(r['artists'])) for r in rows]
+
+    def get_last_played(self, title, artist=None, channel=None):
+        history = self.get_song_history(title, artist, channel)
+        return history[0] if len(history) > 0 else None
+
+    def count_plays(self, title, artist=None, since=None, channel=None):
+        history = self.get_song_history(title, artist, channel)
+        if since is not None:
+            history = [h for h in history if h['timestamp'] >= since.isoformat()]
+        return len(history)
+
+    def get_artist_history(self, artist, since=None, limit=100):
+        query = "SELECT st.channel, st.date, s.title, s.artists, s.timestamp FROM song_artists a JOIN songs s ON s.id = a.song_id " \
+                "JOIN streams st ON st.id = s.stream_id WHERE a.norm_artist = ?"
+        params = [normalize_artist(artist)]
+
+        if since is not None:
+            query += " AND s.timestamp >= ?"
+            params.append(since.isoformat())
+
+        with self.lock:
+            rows = self.conn.execute(query + " ORDER BY s.timestamp DESC LIMIT ?", params + [limit]).fetchall()
+        return [dict(r, artists=json.loads(r['artists'])) for r in rows]
+
+    def get_top_submitters(self, since=None, limit=10):
+        query = "SELECT u.name, COUNT(*) AS songs FROM songs s JOIN submitters u ON u.id = s.submitter_id"
+        params = []
+
+        if since is not None:
+            query += " WHERE s.timestamp >= ?"
+            params.append(since.isoformat())
+
+        with self.lock:
+            rows = self.conn.execute(query + " GROUP BY u.id ORDER BY songs DESC LIMIT ?", params + [limit]).fetchall()
+        return [(r['name'], r['songs']) for r in rows]
+
+    def get_top_songs(self, since=None, limit=10):
+        query = "SELECT MIN(s.title) AS title, s.artists, COUNT(*) AS plays FROM songs s"
+        params = []
+
+        if since is not None:
+            query += " WHERE s.timestamp >= ?"
+            params.append(since.isoformat())
+
+        with self.lock:
+            rows = self.conn.execute(query + " GROUP BY s.norm_title, s.artists ORDER BY plays DESC LIMIT ?", params + [limit]).fetchall()
+        return [(r['title'], json.loads(r['artists']), r['plays']) for r in rows]
+
+
+def demo_import_and_query():
+    config = {}
+
+    with open('.\\config.json') as f:
+        config = json.load(f)
+
+    archive = SetlistArchive(os.path.join(config['recordedSavePath'], 'setlists.db'))
+
+    start = time.perf_counter()
+    count = archive.import_json_files(config['recordedSavePath'] + '\\setlists')
+    print(f"imported {count} setlists in {time.perf_counter() - start:.1f} seconds")
+
+    top = archive.get_top_songs(since=datetime.datetime(datetime.date.today().year, 1, 1))
+    print(top)
+
+    if len(top) > 0:
+        start = time.perf_counter()
+        last = archive.get_last_played(top[0][0], top[0][1][0])
+        plays = archive.count_plays(top[0][0], top[0][1][0], since=datetime.datetime(datetime.date.today().year, 1, 1))
+        print(f"last played: {last} ({plays} times this year) in {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    print(archive.get_top_submitters())
+    archive.close()
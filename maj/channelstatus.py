@@ -0,0 +1,54 @@
+import time
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class ChannelStatus:
+    """
+    Caches the stream info of a channel (from /helix/streams) for `ttl` seconds and
+    makes concurrent callers share a single request when the cache needs refreshing.
+    """
+
+    def __init__(self, fetch, ttl=60):
+        self.fetch = fetch # coroutine function that returns the stream dict (or None when offline)
+        self.ttl = ttl
+        self.stream = None
+        self.fetched_at = None
+        self.pending = None
+
+    def is_fresh(self):
+        return self.fetched_at is not None and time.monotonic() - self.fetched_at < self.ttl
+
+    def invalidate(self):
+        self.fetched_at = None
+
+    async def get_stream(self):
+        if self.is_fresh():
+            return self.stream
+
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(self.refresh())
+
+        # shielded so a caller being cancelled does not cancel the request for everyone else
+        return await asyncio.shield(self.pending)
+
+    async def refresh(self):
+        try:
+            self.stream = await self.fetch()
+            self.fetched_at = time.monotonic()
+            return self.stream
+        finally:
+            self.pending = None
+
+    async def is_online(self):
+        return await self.get_stream() is not None
+
+    async def get_title(self):
+        stream = await self.get_stream()
+        return stream.get('title', '') if stream is not None else ''
+
+    async def get_started_at(self):
+        stream = await self.get_stream()
+        return stream.get('started_at') if stream is not None else None
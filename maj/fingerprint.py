@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import threading
+import collections
+import logging
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from maj.transitions import get_spectrogram
+
+log = logging.getLogger(__name__)
+
+PEAK_TIME_RADIUS = 3 # frames on each side a peak has to be the max of
+PEAK_FREQ_RADIUS = 10 # bins on each side a peak has to be the max of
+PEAK_PERCENTILE = 90 # ignore peaks quieter than this percentile of the spectrogram
+PEAKS_PER_FRAME = 5 # only the strongest peaks of each frame are kept
+FAN_OUT = 5 # number of later peaks each peak is paired with
+MAX_PAIR_FRAMES = 63 # max frames between paired peaks (must fit in 6 bits)
+
+
+def get_peaks(mags):
+    """
+    Returns (frame, bin) of the local maxima of the log spectrogram.
+    """
+    m = np.log1p(mags * 1000)
+
+    # separable max filter over the time and frequency neighborhood
+    padded = np.pad(m, ((PEAK_TIME_RADIUS, PEAK_TIME_RADIUS), (0, 0)), mode='constant')
+    local_max = sliding_window_view(padded, 2 * PEAK_TIME_RADIUS + 1, axis=0).max(axis=-1)
+    padded = np.pad(local_max, ((0, 0), (PEAK_FREQ_RADIUS, PEAK_FREQ_RADIUS)), mode='constant')
+    local_max = sliding_window_view(padded, 2 * PEAK_FREQ_RADIUS + 1, axis=1).max(axis=-1)
+
+    is_peak = (m == local_max) & (m > np.percentile(m, PEAK_PERCENTILE))
+
+    # keep the strongest peaks of each frame so noise does not add extra hashes
+    strength = np.where(is_peak, m, -np.inf)
+    top = np.argsort(strength, axis=1)[:, -PEAKS_PER_FRAME:]
+    keep = np.zeros_like(is_peak)
+    np.put_along_axis(keep, top, True, axis=1)
+
+    frames, bins = np.nonzero(is_peak & keep)
+    return frames, bins
+
+
+def compute_fingerprint(pcm, sample_rate):
+    """
+    Hashes pairs of spectral peaks (freq1, freq2, time delta) into a set of ints.
+    """
+    mags, freqs = get_spectrogram(pcm, sample_rate)
+    frames, bins = get_peaks(mags)
+
+    hashes = set()
+    for i in range(len(frames)):
+        paired = 0
+        for j in range(i + 1, len(frames)):
+            dt = frames[j] - frames[i]
+            if dt == 0:
+                continue
+            if dt > MAX_PAIR_FRAMES or paired >= FAN_OUT:
+                break
+
+            hashes.add((int(bins[i]) << 16) | (int(bins[j]) << 6) | int(dt))
+            paired += 1
+
+    return hashes
+
+
+class FingerprintCache:
+    """
+    Persistent cache of song info keyed by the fingerprint of the sample that was identified.
+    A sample similar enough to a cached one returns the cached info without calling ACR.
+    """
+
+    def __init__(self, path, similarity=0.3, max_entries=500, max_age_hours=24):
+        self.path = path
+        self.similarity = similarity # fraction of shared hashes that counts as the same audio
+        self.max_entries = max_entries
+        self.max_age_s = max_age_hours * 3600
+
+        self.entries = collections.OrderedDict() # id -> {'hashes', 'info', 'created', 'last_hit'} (least recently used first)
+        self.index = collections.defaultdict(set) # hash -> ids of entries with that hash
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.last_similarity = 0.0 # best similarity of the last lookup (useful to tune the threshold)
+
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except Exception as e:
+            log.error(f"could not read fingerprint cache: {e}")
+            return
+
+        for e in sorted(saved.get('entries', []), key=lambda x: x['last_hit']):
+            self._add_entry(set(e['hashes']), e['info'], e['created'], e['last_hit'])
+
+        self.evict()
+
+    def save(self):
+        entries = [{'hashes': list(e['hashes']), 'info': e['info'], 'created': e['created'], 'last_hit': e['last_hit']} for e in self.entries.values()]
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'entries': entries}, f)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, fingerprint):
+        with self.lock:
+            self.evict()
+
+            counts = collections.Counter()
+            for h in fingerprint:
+                for entry_id in self.index.get(h, ()):
+                    counts[entry_id] += 1
+
+            best_id, best_similarity = None, 0.0
+            for entry_id, shared in counts.items():
+                similarity = shared / max(1, min(len(fingerprint), len(self.entries[entry_id]['hashes'])))
+                if similarity > best_similarity:
+                    best_id, best_similarity = entry_id, similarity
+
+            self.last_similarity = best_similarity
+
+            if best_id is None or best_similarity < self.similarity:
+                self.misses += 1
+                log.debug(f"fingerprint cache miss (best similarity {best_similarity:.2f}) {self.get_stats()}")
+                return None
+
+            entry = self.entries[best_id]
+            entry['last_hit'] = time.time()
+            self.entries.move_to_end(best_id)
+            self.hits += 1
+            log.info(f"fingerprint cache hit (similarity {best_similarity:.2f}) {self.get_stats()}")
+            return entry['info']
+
+    def add(self, fingerprint, info):
+        if len(fingerprint) == 0:
+            return
+
+        with self.lock:
+            now = time.time()
+            self._add_entry(set(fingerprint), info, now, now)
+            self.evict()
+            self.save()
+
+    def evict(self):
+        now = time.time()
+
+        while len(self.entries) > 0:
+            entry_id, entry = next(iter(self.entries.items()))
+            is_expired = self.max_age_s > 0 and now - entry['created'] > self.max_age_s
+            if not is_expired and len(self.entries) <= self.max_entries:
+                break
+            self._remove_entry(entry_id)
+
+        # expired entries that were hit recently are not at the front so check them too
+        if self.max_age_s > 0:
+            for entry_id in [i for i, e in self.entries.items() if now - e['created'] > self.max_age_s]:
+                self._remove_entry(entry_id)
+
+    def get_stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0.0
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(hit_rate, 3), 'entries': len(self.entries)}
+
+    def _add_entry(self, hashes, info, created, last_hit):
+        entry_id = self.next_id
+        self.next_id += 1
+
+        self.entries[entry_id] = {'hashes': hashes, 'info': info, 'created': created, 'last_hit': last_hit}
+        for h in hashes:
+            self.index[h].add(entry_id)
+
+    def _remove_entry(self, entry_id):
+        entry = self.entries.pop(entry_id)
+        for h in entry['hashes']:
+            ids = self.index.get(h)
+            if ids is not None:
+                ids.discard(entry_id)
+                if len(ids) == 0:
+                    del self.index[h]
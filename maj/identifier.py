@@ -4,60 +4,374 @@ import hmac
 import os
 import sys
 import time
-import requests
 import json
+import asyncio
 import logging
-from maj.utils.fileutils import get_all_files
+import datetime
+import threading
+import collections
+import aiohttp
+from maj.samplestore import SampleStore
+from maj.persister import WriteBehind
+from maj.fingerprint import compute_fingerprint
+from maj.utils.audio import decode_pcm, ACR_SAMPLE_RATE
 
 log = logging.getLogger(__name__)
 
+CONTENT_TYPES = {'.wav': 'audio/wav', '.ogg': 'audio/ogg', '.mp3': 'audio/mpeg'}
+MIN_LATENCY_SAMPLES = 5 # latencies needed before the p95 is used as the hedge delay
+MIN_HEDGE_DELAY = 0.5
+
+PRIORITY_USER = 0 # someone in chat asked (!track)
+PRIORITY_BACKGROUND = 1 # auto-id
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, capacity, period_s, tokens=None, updated=None):
+        self.capacity = capacity
+        self.rate = capacity / period_s # tokens refilled per second
+        self.tokens = capacity if tokens is None else tokens
+        self.updated = time.time() if updated is None else updated
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def get_fill(self):
+        return self.tokens / self.capacity
+
+    def json(self):
+        return {'tokens': self.tokens, 'updated': self.updated}
+
+
+class AcrQuota:
+    """
+    Limits how many requests are sent to ACR with token buckets per minute, hour and month.
+    Background (auto-id) requests are shed once any bucket drops below `background_reserve`
+    so there is always budget left for users. Counters are saved to disk (by a background thread
+    after `save_delay` seconds) so they survive restarts.
+    """
+
+    def __init__(self, path, per_minute=0, per_hour=0, per_month=0, background_reserve=0.2, save_delay=1.0):
+        self.path = path
+        self.background_reserve = background_reserve
+        self.setlist_date = datetime.date.today().isoformat() # spend is reported per setlist date
+        self.spend = {} # setlist date -> {'user': count, 'background': count}
+        self.lock = threading.RLock() # counters are read by the write behind thread while saving
+
+        self.buckets = {}
+        for name, limit, period_s in [('minute', per_minute, 60), ('hour', per_hour, 3600), ('month', per_month, 30 * 86400)]:
+            if limit > 0:
+                self.buckets[name] = TokenBucket(limit, period_s)
+
+        self.load()
+        self.persister = WriteBehind(self.save, delay=save_delay, name='acr-quota-writer')
+
+    def close(self):
+        self.persister.stop()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                saved = json.load(f)
+        except Exception as e:
+            log.error(f"could not read acr quota: {e}")
+            return
+
+        self.spend = saved.get('spend', {})
+        for name, b in saved.get('buckets', {}).items():
+            if name in self.buckets:
+                self.buckets[name].tokens = min(self.buckets[name].capacity, b['tokens'])
+                self.buckets[name].updated = b['updated']
+
+    def save(self):
+        with self.lock:
+            saved = json.dumps({'buckets': {n: b.json() for n, b in self.buckets.items()}, 'spend': self.spend}, indent=4)
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(saved)
+        os.replace(tmp_path, self.path)
+
+    def get_fill(self):
+        """
+        Fraction of budget left in the emptiest bucket (1.0 when there are no limits).
+        """
+        with self.lock:
+            for b in self.buckets.values():
+                b.refill()
+            return min([b.get_fill() for b in self.buckets.values()], default=1.0)
+
+    def acquire(self, priority=PRIORITY_USER):
+        with self.lock:
+            self.get_fill() # refills buckets
+
+            if any(b.tokens < 1 for b in self.buckets.values()):
+                log.warning(f"acr quota exhausted {self.get_levels()}")
+                return False
+
+            # background requests can not dip into the reserve
+            fill_after = min([(b.tokens - 1) / b.capacity for b in self.buckets.values()], default=1.0)
+            if priority == PRIORITY_BACKGROUND and fill_after < self.background_reserve:
+                log.info(f"acr quota low. skipping background request {self.get_levels()}")
+                return False
+
+            for b in self.buckets.values():
+                b.tokens -= 1
+
+            counts = self.spend.setdefault(self.setlist_date, {'user': 0, 'background': 0})
+            counts['user' if priority == PRIORITY_USER else 'background'] += 1
+
+        self.persister.mark_dirty() # saved off the event loop
+        return True
+
+    def stretch_interval(self, interval):
+        """
+        Returns a longer auto-id interval when the budget is getting low (up to 10x).
+        """
+        fill = self.get_fill()
+        if fill >= 0.5:
+            return interval
+        return interval * min(10.0, 0.5 / max(fill, 0.05))
+
+    def get_levels(self):
+        return {n: round(b.tokens, 1) for n, b in self.buckets.items()}
+
+    def report(self):
+        """
+        Number of requests sent per setlist date.
+        """
+        return {date: dict(counts, total=counts['user'] + counts['background']) for date, counts in sorted(self.spend.items())}
+
+
+class AcrEndpoint:
+    """
+    An ACR host/project and the recent latencies of requests sent to it.
+    """
+
+    def __init__(self, url, key, secret, window=50):
+        self.url = url
+        self.access_key = key
+        self.access_secret = secret
+        self.latencies = collections.deque(maxlen=window)
+
+    def add_latency(self, seconds):
+        self.latencies.append(seconds)
+
+    def get_p95(self, default):
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return default
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+
 class Identifier:
-    def __init__(self, key, secret, url):
+    def __init__(self, key, secret, url, fingerprint_cache=None, timeout=20, pool_size=10, endpoints=None, hedge_delay=3.0, quota=None):
         self.access_key = key
         self.access_secret = secret
         self.url = url
-        self.is_identifying = False
+        self.in_flight = 0 # number of identify requests currently waiting on ACR
+
+        # first endpoint is the primary. the others are only used when the primary is slow or fails
+        self.endpoints = [AcrEndpoint(url, key, secret)]
+        for e in endpoints or []:
+            self.endpoints.append(AcrEndpoint(e['url'], e.get('key', key), e.get('secret', secret)))
+
+        self.hedge_delay = hedge_delay # used until enough latencies are known to use the p95
+
+        # when set, every request sent to ACR (including hedged ones) has to fit in the quota
+        self.quota = quota
+
+        # when set, samples similar to one already identified are answered from the cache
+        self.fingerprint_cache = fingerprint_cache
+
+        self.timeout = timeout # seconds allowed for upload + response
+        self.pool_size = pool_size
+        self.session = None
+        self.measuring = set() # hedged requests that lost but are left to finish so their real latency is known
 
         self.http_method = "POST"
         self.http_uri = "/v1/identify"
         self.signature_version = "1"
 
-    def identify(self, file_path, data_type='audio'):
+    @property
+    def is_identifying(self):
+        return self.in_flight > 0
+
+    def get_session(self):
+        # created lazily because the session has to be created inside the running event loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
+
+    async def close(self):
+        for task in self.measuring:
+            task.cancel()
+        await asyncio.gather(*self.measuring, return_exceptions=True)
+
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def get_hedge_delay(self, endpoint):
+        return min(self.timeout, max(MIN_HEDGE_DELAY, endpoint.get_p95(self.hedge_delay)))
+
+    async def identify(self, sample, data_type='audio', ext='.wav', priority=PRIORITY_USER):
+        """
+        Sends the sample (file path or bytes) to ACR and returns the json response.
+        When more than one endpoint is configured the request is hedged: if the primary
+        has not answered within its p95 latency the sample is also sent to the next endpoint
+        and whichever answers first is used.
+        Raises QuotaExceeded when the quota does not allow the request.
+        """
+        if self.quota is not None and not self.quota.acquire(priority):
+            raise QuotaExceeded(f"acr quota does not allow request (priority {priority})")
+
+        self.in_flight += 1
+
+        try:
+            if len(self.endpoints) == 1:
+                return await self.identify_on(self.endpoints[0], sample, data_type, ext)
+            return await self.identify_hedged(sample, data_type, ext, priority)
+        finally:
+            self.in_flight -= 1
+
+    async def identify_hedged(self, sample, data_type, ext, priority=PRIORITY_USER):
+        remaining = list(self.endpoints)
+        pending = {}
+
+        def start_next():
+            is_first = len(remaining) == len(self.endpoints) # first request was already counted in identify()
+            if not is_first and self.quota is not None and not self.quota.acquire(priority):
+                remaining.clear() # no budget for another request so just wait on what was sent
+                return None
+
+            endpoint = remaining.pop(0)
+
+            task = asyncio.create_task(self.identify_on(endpoint, sample, data_type, ext))
+            pending[task] = endpoint
+            return endpoint
+
+        current = start_next()
+
+        try:
+            while len(pending) > 0:
+                timeout = self.get_hedge_delay(current) if len(remaining) > 0 else None
+                done, _ = await asyncio.wait(pending.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if len(done) == 0:
+                    log.info(f"no response from {current.url} after {timeout:.2f}s. hedging ...")
+                    current = start_next() or current
+                    continue
+
+                for task in done:
+                    endpoint = pending.pop(task)
+                    if task.exception() is None and task.result() is not None:
+                        if endpoint is not self.endpoints[0]:
+                            log.info(f"hedged request answered first by {endpoint.url}")
+                        return task.result()
 
-        self.is_identifying = True
+                    log.warning(f"request to {endpoint.url} failed: {task.exception()}")
 
+                # everything sent so far failed so try the next endpoint right away
+                if len(pending) == 0 and len(remaining) > 0:
+                    current = start_next() or current
+
+            return None
+        finally:
+            # the losers were already sent (and counted in the quota) so let them finish in the background.
+            # cancelling them would only record how long they were waited on, not how slow the endpoint is
+            for task in pending.keys():
+                self.measuring.add(task)
+                task.add_done_callback(self.on_measured)
+
+    def on_measured(self, task):
+        self.measuring.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.debug(f"hedged request that lost failed: {task.exception()}")
+
+    async def identify_on(self, endpoint, sample, data_type='audio', ext='.wav'):
         timestamp = time.time()
 
-        string_to_sign = self.http_method + "\n" + self.http_uri + "\n" + self.access_key + "\n" + data_type + "\n" + self.signature_version + "\n" + str(
+        string_to_sign = self.http_method + "\n" + self.http_uri + "\n" + endpoint.access_key + "\n" + data_type + "\n" + self.signature_version + "\n" + str(
             timestamp)
 
-        sign = base64.b64encode(hmac.new(self.access_secret.encode('ascii'), string_to_sign.encode('ascii'),
+        sign = base64.b64encode(hmac.new(endpoint.access_secret.encode('ascii'), string_to_sign.encode('ascii'),
                                          digestmod=hashlib.sha1).digest()).decode('ascii')
 
-        f = open(file_path, "rb")
-        sample_bytes = os.path.getsize(file_path)
+        f = None
+        started = time.monotonic()
 
-        files = [
-            ('sample', ('sample.mp4', f, 'audio/mpeg'))
-        ]
-        data = {'access_key': self.access_key,
-                'sample_bytes': sample_bytes,
-                'timestamp': str(timestamp),
-                'signature': sign,
-                'data_type': data_type,
-                "signature_version": self.signature_version}
+        try:
+            if isinstance(sample, (bytes, bytearray)):
+                sample_bytes = len(sample)
+                payload = sample
+            else:
+                ext = os.path.splitext(sample)[1].lower()
+                sample_bytes = os.path.getsize(sample)
+                payload = f = open(sample, "rb")
 
-        r = requests.post(self.url, files=files, data=data)
-        r.encoding = "utf-8"
+            form = aiohttp.FormData()
+            form.add_field('access_key', endpoint.access_key)
+            form.add_field('sample_bytes', str(sample_bytes))
+            form.add_field('timestamp', str(timestamp))
+            form.add_field('signature', sign)
+            form.add_field('data_type', data_type)
+            form.add_field('signature_version', self.signature_version)
+            form.add_field('sample', payload, filename='sample' + ext, content_type=CONTENT_TYPES.get(ext, 'audio/mpeg'))
 
-        self.is_identifying = False
+            async with self.get_session().post(endpoint.url, data=form, timeout=aiohttp.ClientTimeout(total=self.timeout)) as r:
+                if r.status == 200:
+                    response = await r.json(encoding='utf-8', content_type=None)
+                    endpoint.add_latency(time.monotonic() - started)
+                    return response
+                else:
+                    log.warning(str(r.status) + ' - ' + str(r.reason))
+                    return None
+        except asyncio.TimeoutError:
+            # latency is at least this long so slow endpoints still get a longer hedge delay
+            endpoint.add_latency(time.monotonic() - started)
+            raise
+        finally:
+            if f is not None:
+                f.close()
 
-        if r.status_code == 200:
-            response = r.json()
-            return response
-        else:
-            log.warning(str(r.status_code) + ' - ' + r.reason)
-            return None
+    async def get_song_info(self, sample, priority=PRIORITY_USER):
+        """
+        Identifies the sample and returns the song info (or None if not identified).
+        Uses the fingerprint cache (if set) before sending the sample to ACR.
+        """
+        fingerprint = None
+        loop = asyncio.get_running_loop()
+
+        if self.fingerprint_cache is not None:
+            try:
+                pcm = await loop.run_in_executor(None, decode_pcm, sample)
+                fingerprint = await loop.run_in_executor(None, compute_fingerprint, pcm, ACR_SAMPLE_RATE)
+                info = self.fingerprint_cache.lookup(fingerprint)
+                if info is not None:
+                    return info
+            except Exception as e:
+                log.error(f"fingerprint lookup failed: {e}")
+
+        response = await self.identify(sample, priority=priority)
+        info = self.get_song_info_from_response(response)
+
+        if info is not None and fingerprint is not None:
+            # play offset is only true for this sample so it is not cached
+            cached_info = {k: v for k, v in info.items() if k != 'play_offset_s'}
+            await loop.run_in_executor(None, self.fingerprint_cache.add, fingerprint, cached_info)
+
+        return info
 
     def get_song_info_from_response(self, response):
         if response is None or response['status']['msg'] != "Success":
@@ -73,14 +387,17 @@ class Identifier:
             artists = [v['name'] for v in song['artists']]
             album = song['album']['name']
 
+            play_offset_ms = song.get('play_offset_ms')
+
             return {'title': title,
                     'artists': artists, 
                     'album': album, 
                     'duration_s': song['duration_ms'] / 1000,
+                    'play_offset_s': play_offset_ms / 1000 if play_offset_ms is not None else None,
                     'multipleResults': len(response['metadata']['music']) > 1}
 
 
-def sample_get():
+async def sample_get():
     """
     Sample function to show usage of Identifier
     """
@@ -95,9 +412,10 @@ def sample_get():
     requrl = config['acrHostUrl']
 
     identifier = Identifier(access_key, access_secret, requrl)
-    response = identifier.identify(
+    response = await identifier.identify(
         'F:\\twitch\\recorded\\myanalogjournal_\\myanalogjournal_ - 2021-06-30 15h47m20s.mp4')
     info = identifier.get_song_info_from_response(response)
+    await identifier.close()
 
     if info is None:
         print("Could not identify the current song ...")
@@ -107,7 +425,7 @@ def sample_get():
             info['artists']) + '\nAlbum: ' + info['album'])
 
 
-def demo_create_from_files():
+async def demo_create_from_files():
     from maj.songlist import Song,SongList
     import datetime
     
@@ -124,19 +442,60 @@ def demo_create_from_files():
     identifier = Identifier(access_key, access_secret, requrl)
     playlist = SongList(config['recordedSavePath'], config['channel'], datetime.datetime.today())
 
-    files = get_all_files('F:\\twitch\\recorded\\myanalogjournal_', recursive=False)
-    files.sort()
+    store = SampleStore('F:\\twitch\\recorded\\myanalogjournal_')
+    files = store.get_files()
 
     for f in files:
         print(f)
         if '2021-06-30' not in f: 
             continue
 
-        response = identifier.identify(f)
-        info = identifier.get_song_info_from_response(response)
+        store.touch(f) # reused so it is evicted after samples that were not
+        info = await identifier.get_song_info(f)
         
         if info is not None:
             playlist.add(Song(info))
 
+    await identifier.close()
+
+async def demo_hedged_requests():
+    """
+    Starts two local stand-in ACR servers (the primary is slow) and shows the hedged request
+    being answered by the secondary.
+    """
+    from aiohttp import web
+
+    def create_app(name, delay):
+        async def handle(request):
+            await request.post()
+            await asyncio.sleep(delay)
+            return web.json_response({'status': {'msg': 'Success', 'code': 0},
+                                      'metadata': {'music': [{'title': name, 'artists': [{'name': 'demo'}], 'album': {'name': ''}, 'duration_ms': 1000}]}})
+        app = web.Application()
+        app.router.add_post('/v1/identify', handle)
+        return app
+
+    runners = []
+    for port, name, delay in [(8701, 'primary', 2.0), (8702, 'secondary', 0.1)]:
+        runner = web.AppRunner(create_app(name, delay))
+        await runner.setup()
+        await web.TCPSite(runner, 'localhost', port).start()
+        runners.append(runner)
+
+    identifier = Identifier('key', 'secret', 'http://localhost:8701/v1/identify',
+                            endpoints=[{'url': 'http://localhost:8702/v1/identify'}], hedge_delay=0.5)
+
+    for i in range(3):
+        started = time.monotonic()
+        info = identifier.get_song_info_from_response(await identifier.identify(b'not really audio'))
+        print(f"{info['title']} answered in {time.monotonic() - started:.2f}s")
+
+    await asyncio.sleep(2.0) # the primary requests that lost are still finishing so their latency is recorded
+    print([list(e.latencies) for e in identifier.endpoints])
+
+    await identifier.close()
+    for runner in runners:
+        await runner.cleanup()
+
 # if __name__ == "__main__":
-    # demo_create_from_files()
+    # asyncio.run(demo_create_from_files())
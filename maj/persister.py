@@ -0,0 +1,88 @@
+import time
+import threading
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehind:
+    """
+    Calls `write` on a background thread shortly after being marked dirty so file io does not
+    block the event loop. Changes marked within `delay` seconds of each other are written together.
+    """
+
+    def __init__(self, write, delay=1.0, name='write-behind'):
+        self.write = write
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.dirty_since = None # time.monotonic() of the first change not written yet
+        self.generation = 0 # incremented on every change
+        self.written = 0 # last generation that was written
+        self.flush_requested = False
+        self.is_running = True
+
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def mark_dirty(self):
+        with self.condition:
+            self.generation += 1
+            if self.dirty_since is None:
+                self.dirty_since = time.monotonic()
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Writes any pending changes now and waits for them. Returns False on timeout.
+        """
+        with self.condition:
+            target = self.generation
+            if target <= self.written:
+                return True # nothing pending (leaving the flag set would skip the next coalescing window)
+
+            self.flush_requested = True
+            self.condition.notify_all()
+            return self.condition.wait_for(lambda: self.written >= target, timeout)
+
+    def stop(self, timeout=10):
+        if not self.flush(timeout):
+            log.warning(f"{self.thread.name} could not write pending changes in {timeout} seconds")
+
+        with self.condition:
+            self.is_running = False
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.dirty_since is not None or not self.is_running)
+                if self.dirty_since is None:
+                    return # stopped with nothing left to write
+
+                # wait a bit so changes close together are written once
+                while self.is_running and not self.flush_requested:
+                    remaining = self.dirty_since + self.delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                if not self.is_running:
+                    return
+
+                target = self.generation
+                self.dirty_since = None
+                self.flush_requested = False
+
+            try:
+                self.write()
+            except Exception as e:
+                log.error(f"{self.thread.name} failed to write: {e}")
+                with self.condition:
+                    if self.dirty_since is None:
+                        self.dirty_since = time.monotonic() # try again after the delay
+                continue
+
+            with self.condition:
+                self.written = target
+                self.condition.notify_all()
@@ -0,0 +1,71 @@
+import time
+import random
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class RetryPolicy:
+    """
+    Decides if and when to try identifying again based on why the last attempt failed.
+    Each kind of failure has its own backoff, jitter and number of retries, and failures
+    that retrying can not fix (channel offline, no ACR quota left) stop right away.
+    """
+
+    OFFLINE = "offline"
+    BLOCKED = "blocked"
+    NETWORK = "network"
+    NO_MATCH = "no_match"
+    QUOTA = "quota"
+
+    # retries: times this failure can happen before giving up (0 = stop on the first one)
+    # delay: seconds before the next attempt, multiplied by factor for every repeat (up to max_delay)
+    DEFAULT_RULES = {
+        OFFLINE: {'retries': 0},
+        QUOTA: {'retries': 0},
+        BLOCKED: {'retries': 2, 'delay': 5, 'factor': 2, 'max_delay': 30, 'jitter': 0.2},
+        NETWORK: {'retries': 3, 'delay': 1, 'factor': 2, 'max_delay': 10, 'jitter': 0.3},
+        # no extra delay since every new sample already holds new audio (recorded, or waited for when buffered)
+        NO_MATCH: {'retries': 3, 'delay': 0, 'factor': 1, 'max_delay': 0, 'jitter': 0},
+    }
+
+    def __init__(self, rules=None):
+        self.rules = {kind: dict(rule) for kind, rule in RetryPolicy.DEFAULT_RULES.items()}
+        for kind, rule in (rules or {}).items():
+            self.rules.setdefault(kind, {}).update(rule)
+
+        self.failures = {}
+        self.resume_at = 0.0 # time.monotonic() before which the next attempt should not start
+        self.is_stopped = False
+
+    def get_delay(self, kind, count):
+        rule = self.rules[kind]
+        delay = min(rule.get('max_delay', 0), rule.get('delay', 0) * rule.get('factor', 1) ** (count - 1))
+        jitter = rule.get('jitter', 0)
+        return max(0.0, delay * random.uniform(1 - jitter, 1 + jitter))
+
+    def on_failure(self, kind):
+        """
+        Records a failed attempt. Returns False when it is not worth trying again.
+        """
+        count = self.failures.get(kind, 0) + 1
+        self.failures[kind] = count
+
+        if count > self.rules[kind].get('retries', 0):
+            log.info(f"not retrying after {kind} failure ({count} so far)")
+            self.is_stopped = True
+            return False
+
+        delay = self.get_delay(kind, count)
+        self.resume_at = max(self.resume_at, time.monotonic() + delay)
+        log.info(f"{kind} failure ({count} so far). retrying in {delay:.1f} seconds ...")
+        return True
+
+    async def wait(self):
+        delay = self.resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def get_failures(self):
+        return dict(self.failures)
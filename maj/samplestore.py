@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import threading
+import subprocess
+import logging
+
+log = logging.getLogger(__name__)
+
+INDEX_FILENAME = "index.json"
+
+# codec name -> (ffmpeg encoder, file extension, bitrate)
+CODECS = {
+    'opus': ('libopus', '.ogg', '32k'),
+    'mp3': ('libmp3lame', '.mp3', '64k'),
+    'aac': ('aac', '.m4a', '48k')
+}
+
+
+class SampleStore:
+    """
+    Keeps track of the recorded samples in an index file so they can be cleaned up
+    without walking the directory. Samples are evicted when they get too old or the
+    total size goes over the budget. Over the budget the oldest are evicted first, by
+    when they were recorded or last reused (touch), so it is mostly by age since samples
+    are only reused by tools that identify old samples again.
+    """
+
+    def __init__(self, root_path, max_bytes=0, max_age_days=0, codec=None):
+        self.root_path = root_path
+        self.index_path = os.path.join(root_path, INDEX_FILENAME)
+        self.max_bytes = max_bytes # 0 = no size limit
+        self.max_age_s = max_age_days * 86400 # 0 = keep forever
+        self.codec = codec if codec in CODECS else None # transcode kept samples when set
+
+        self.entries = {} # filename -> {'size', 'created', 'last_access', 'codec'}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+        if codec is not None and self.codec is None:
+            log.warning(f"unknown sample codec '{codec}'. samples will not be transcoded")
+
+        self.load_index()
+
+    def load_index(self):
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                log.error(f"could not read sample index: {e}")
+                self.entries = {}
+        else:
+            # first run so index whatever was recorded before the store existed
+            self.entries = {}
+            for e in os.scandir(self.root_path):
+                if e.is_file() and e.name != INDEX_FILENAME:
+                    st = e.stat()
+                    self.entries[e.name] = {'size': st.st_size, 'created': st.st_mtime, 'last_access': st.st_mtime, 'codec': None}
+            self.save_index()
+
+        self.total_bytes = sum(e['size'] for e in self.entries.values())
+
+    def save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+
+    def get_path(self, filename):
+        return os.path.join(self.root_path, filename)
+
+    def get_files(self):
+        """
+        Returns full path of all samples ordered by when they were recorded.
+        """
+        with self.lock:
+            names = sorted(self.entries.keys(), key=lambda n: self.entries[n]['created'])
+        return [self.get_path(n) for n in names]
+
+    def add(self, path):
+        if not os.path.exists(path):
+            return
+
+        now = time.time()
+        filename = os.path.basename(path)
+
+        with self.lock:
+            self._remove_entry(filename)
+            self.entries[filename] = {'size': os.path.getsize(path), 'created': now, 'last_access': now, 'codec': None}
+            self.total_bytes += self.entries[filename]['size']
+            self.save_index()
+
+    def touch(self, path):
+        # call when an existing sample is used again so it is kept longer
+        with self.lock:
+            entry = self.entries.get(os.path.basename(path))
+            if entry is not None:
+                entry['last_access'] = time.time()
+                self.save_index()
+
+    def release(self, path):
+        """
+        Called once a sample is no longer needed for identification. Transcodes it
+        (if a codec is configured) and evicts samples that are over the limits.
+        """
+        if self.codec is not None:
+            self.transcode(path)
+
+        self.evict()
+
+    def transcode(self, path):
+        filename = os.path.basename(path)
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None or entry['codec'] is not None:
+                return path
+
+        encoder, ext, bitrate = CODECS[self.codec]
+        out_path = os.path.splitext(path)[0] + ext
+        cmds = ["ffmpeg", "-y", "-loglevel", "error", "-i", path, "-vn", "-ac", "1", "-c:a", encoder, "-b:a", bitrate, out_path]
+
+        try:
+            subprocess.run(cmds, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except Exception as e:
+            log.error(f"failed to transcode {filename}: {e}")
+            return path
+
+        with self.lock:
+            self._remove_entry(filename)
+            self._delete_file(path)
+
+            out_name = os.path.basename(out_path)
+            self.entries[out_name] = dict(entry, size=os.path.getsize(out_path), codec=self.codec)
+            self.total_bytes += self.entries[out_name]['size']
+            self.save_index()
+
+        return out_path
+
+    def evict(self):
+        now = time.time()
+        removed = 0
+
+        with self.lock:
+            if self.max_age_s > 0:
+                for name in [n for n, e in self.entries.items() if now - e['created'] > self.max_age_s]:
+                    self._remove_entry(name, delete=True)
+                    removed += 1
+
+            if self.max_bytes > 0 and self.total_bytes > self.max_bytes:
+                for name in sorted(self.entries.keys(), key=lambda n: self.entries[n]['last_access']):
+                    if self.total_bytes <= self.max_bytes:
+                        break
+                    self._remove_entry(name, delete=True)
+                    removed += 1
+
+            if removed > 0:
+                self.save_index()
+
+        if removed > 0:
+            log.info(f"evicted {removed} samples ({self.total_bytes} bytes remaining)")
+
+        return removed
+
+    def _remove_entry(self, filename, delete=False):
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            self.total_bytes -= entry['size']
+            if delete:
+                self._delete_file(self.get_path(filename))
+
+    def _delete_file(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.error(f"could not delete {path}: {e}")
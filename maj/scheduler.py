@@ -0,0 +1,196 @@
+import time
+import asyncio
+import collections
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class AdaptiveSchedule:
+    """
+    Decides how long auto-id should wait before the next check. Uses the duration and
+    play offset of the last identified song to sleep until shortly before it should end,
+    then checks more often around the expected transition. Falls back to the fixed
+    interval when that info is not known.
+    """
+
+    def __init__(self, interval, lead_seconds=15, dense_interval=10, dense_window=90, max_sleep=600):
+        self.interval = interval # fixed interval used when the end of the song is unknown
+        self.lead_seconds = lead_seconds # start checking this long before the song should end
+        self.dense_interval = dense_interval # interval used around the expected end of the song
+        self.dense_window = dense_window # keep checking densely this long after the expected end
+        self.max_sleep = max_sleep
+        self.track_end = None # estimated time.monotonic() when the current song ends
+
+    def update(self, info):
+        """
+        Called with the song info of every successful identification.
+        """
+        duration = info.get('duration_s', 0)
+        offset = info.get('play_offset_s')
+
+        if duration <= 0 or offset is None or offset > duration:
+            self.track_end = None
+            return
+
+        self.track_end = time.monotonic() + duration - offset
+        log.debug(f"'{info['title']}' should end in {duration - offset:.0f} seconds")
+
+    def next_delay(self):
+        if self.track_end is None:
+            return self.interval
+
+        until_end = self.track_end - time.monotonic()
+
+        if until_end > self.lead_seconds:
+            return min(until_end - self.lead_seconds, self.max_sleep)
+
+        if until_end > -self.dense_window:
+            return self.dense_interval
+
+        # well past the estimate (e.g. a long mix) so go back to the fixed interval
+        self.track_end = None
+        return self.interval
+
+
+class IdentifyScheduler:
+    """
+    Owns the identify state so only one identification runs at a time instead of polling a
+    flag. Callers that do not join the identification in progress (see TwitchBot.track_flight)
+    wait their turn first come first served. Waiting is done on asyncio conditions/events
+    so nothing runs between identifications.
+    """
+
+    IDLE = "idle"
+    IDENTIFYING = "identifying"
+    COOLDOWN = "cooldown"
+
+    def __init__(self):
+        self.current_kind = None # kind of request currently identifying (None when not identifying)
+        self.is_cooling_down = False
+        self.waiting = collections.deque() # (ticket, kind) in the order they asked
+        self.condition = asyncio.Condition()
+        self.wake_event = asyncio.Event()
+
+    @property
+    def state(self):
+        if self.current_kind is not None:
+            return IdentifyScheduler.IDENTIFYING
+        if self.is_cooling_down:
+            return IdentifyScheduler.COOLDOWN
+        return IdentifyScheduler.IDLE
+
+    @property
+    def is_identifying(self):
+        return self.current_kind is not None
+
+    @property
+    def queue_depth(self):
+        return len(self.waiting)
+
+    def get_status(self):
+        return {'state': self.state, 'current': self.current_kind, 'queue_depth': self.queue_depth,
+                'waiting': [kind for _, kind in self.waiting]}
+
+    async def run(self, kind, func, *args, **kwargs):
+        """
+        Waits for its turn then runs the identify coroutine function.
+        """
+        ticket = object()
+
+        async with self.condition:
+            # queued only once the lock is held so a task cancelled before that leaves nothing behind
+            self.waiting.append((ticket, kind))
+            try:
+                await self.condition.wait_for(lambda: not self.is_identifying and self.waiting[0][0] is ticket)
+            except BaseException:
+                self.waiting.remove((ticket, kind))
+                self.condition.notify_all()
+                raise
+
+            self.waiting.popleft()
+            self.current_kind = kind
+            log.debug(f"identify scheduler: {self.get_status()}")
+
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            async with self.condition:
+                self.current_kind = None
+                self.condition.notify_all()
+            log.debug(f"identify scheduler: {self.get_status()}")
+
+    async def cooldown(self, delay):
+        """
+        Waits between auto-id checks. Returns early when wake() is called.
+        """
+        self.is_cooling_down = True
+        self.wake_event.clear()
+
+        try:
+            await asyncio.wait_for(self.wake_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.is_cooling_down = False
+
+    def wake(self):
+        self.wake_event.set()
+
+
+class DemandTracker:
+    """
+    Sliding window count of viewers asking what is playing (identify intents and !track).
+    When enough people ask within the window an identification is started before anyone
+    has to type !track, and auto-id checks less often while chat is not asking.
+    """
+
+    def __init__(self, window=60, threshold=3, retrigger_seconds=60, quiet_seconds=300, quiet_factor=2.0):
+        self.window = window
+        self.threshold = threshold # requests within the window that start a speculative identification
+        self.retrigger_seconds = retrigger_seconds # min time between speculative identifications
+        self.quiet_seconds = quiet_seconds # no requests for this long counts as a quiet chat
+        self.quiet_factor = quiet_factor # auto-id interval multiplier while chat is quiet
+        self.requests = collections.deque() # (time.monotonic(), kind) oldest first
+        self.last_request = None
+        self.last_triggered = None
+
+    def prune(self, now):
+        while len(self.requests) > 0 and now - self.requests[0][0] > self.window:
+            self.requests.popleft()
+
+    def get_count(self):
+        self.prune(time.monotonic())
+        return len(self.requests)
+
+    def record(self, kind):
+        """
+        Counts a request and returns True when demand crossed the threshold (speculative
+        identification should start).
+        """
+        now = time.monotonic()
+        self.prune(now)
+        self.requests.append((now, kind))
+        self.last_request = now
+
+        if len(self.requests) < self.threshold:
+            return False
+
+        if self.last_triggered is not None and now - self.last_triggered < self.retrigger_seconds:
+            return False
+
+        self.last_triggered = now
+        log.info(f"chat demand crossed threshold: {self.get_status()}")
+        return True
+
+    def is_quiet(self):
+        return self.last_request is None or time.monotonic() - self.last_request > self.quiet_seconds
+
+    def stretch_interval(self, interval):
+        if self.is_quiet():
+            return interval * self.quiet_factor
+        return interval
+
+    def get_status(self):
+        kinds = collections.Counter(kind for _, kind in self.requests)
+        return {'count': len(self.requests), 'window': self.window, **kinds}
@@ -3,11 +3,26 @@ import os
 import json
 import csv
 import string
+import time
+import tempfile
+import threading
 import imgkit
 from tabulate import tabulate
 from maj.utils.botreplys import get_stream_name_by_day
+from maj.persister import WriteBehind
+
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+
+def get_song_key(title, artists):
+    # songs with the same key are treated as the same song (case and punctuation are ignored in the title)
+    return (title.lower().translate(PUNCTUATION_TABLE), tuple(artists))
+
 
 class Song:
+    # slots keep a loaded setlist small (no per song __dict__)
+    __slots__ = ('title', 'album', 'artists', 'duration_s', 'added_by', 'was_found', '_timestamp', '_last_timestamp')
+
     def __init__(self, info):
         self.title = info['title']
         self.album = info['album']
@@ -16,16 +31,43 @@ class Song:
         self.added_by = info.get('added_by', '')
         self.was_found = info.get('was_found', False)
 
+        # saved timestamps are kept as iso strings until used (most loaded songs never need them parsed)
         if info.get('last_timestamp', None) is None:
-            self.last_timestamp = datetime.datetime.now()
+            self._last_timestamp = datetime.datetime.now()
         else:
-            self.last_timestamp = datetime.datetime.fromisoformat(info['last_timestamp'])
+            self._last_timestamp = info['last_timestamp']
 
         # timestamp is datetime of first identification of the song
         if info.get('timestamp', None) is None:
-            self.timestamp = datetime.datetime.now()
+            self._timestamp = datetime.datetime.now()
         else:
-            self.timestamp = datetime.datetime.fromisoformat(info['timestamp'])
+            self._timestamp = info['timestamp']
+
+    @property
+    def timestamp(self):
+        if isinstance(self._timestamp, str):
+            self._timestamp = datetime.datetime.fromisoformat(self._timestamp)
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self._timestamp = value
+
+    @property
+    def last_timestamp(self):
+        if isinstance(self._last_timestamp, str):
+            self._last_timestamp = datetime.datetime.fromisoformat(self._last_timestamp)
+        return self._last_timestamp
+
+    @last_timestamp.setter
+    def last_timestamp(self, value):
+        self._last_timestamp = value
+
+    def get_sort_key(self):
+        # iso strings written by json() sort the same as the datetimes so sorting does not have to parse them
+        if isinstance(self._timestamp, str) and len(self._timestamp) > 10 and self._timestamp[10] == 'T':
+            return self._timestamp
+        return self.timestamp.isoformat()
 
     def __str__(self):
         return str(self.json())
@@ -83,18 +125,50 @@ class Song:
 
 
 
+def fsync_dir(path):
+    # makes a rename in the directory durable (not supported on windows)
+    if os.name == 'nt':
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class SongList:
-    def __init__(self, save_path, channel, date_of_list):
+    def __init__(self, save_path, channel, date_of_list, use_journal=False, compact_seconds=600, write_behind_seconds=0, archive=None):
         self.songs = []
+        self.index = {} # song key -> songs with that key (in the order they were added)
         self.setlist_start = date_of_list
         self.has_started = False
         self.save_path = save_path + '\\setlists\\' + channel
         self.full_path = self.save_path + '\\' + self.setlist_start.strftime('%Y-%m-%d.json')
         self.stream_title = '' # looked up when user becomes online;
 
+        # when set, the setlist is loaded from and changes are written to the archive (SetlistArchive)
+        self.archive = archive
+        self.channel = channel
+        self.list_date = date_of_list.strftime('%Y-%m-%d')
+
+        # changes are appended to the journal and only written to the full json file when compacted
+        self.journal_path = self.save_path + '\\' + self.setlist_start.strftime('%Y-%m-%d.journal.jsonl')
+        self.use_journal = use_journal
+        self.compact_seconds = compact_seconds
+        self.last_compacted = time.monotonic()
+
+        # with write behind, changes are written by a background thread instead of the caller
+        self.lock = threading.RLock() # held while changing songs or taking a snapshot of them
+        self.pending_records = []
+        self.persister = None
+
         self.init_dir()
         self.load_from_file()
 
+        if write_behind_seconds > 0:
+            self.persister = WriteBehind(self.write_pending, delay=write_behind_seconds, name='setlist-writer')
+
     def __str__(self):
         return str(self.json())
 
@@ -104,39 +178,238 @@ class SongList:
                 'songs': [s.json() for s in self.songs],
                 'stream_title': self.stream_title}
 
+    def get_info(self):
+        # setlist json without the songs
+        return {'setlist_start': self.setlist_start.isoformat(),
+                'has_started': self.has_started,
+                'stream_title': self.stream_title}
+
     def init_dir(self):
         # create directory for setlists if not exist
         if os.path.isdir(self.save_path) is False:
             os.makedirs(self.save_path)
 
     def load_from_file(self):
-        if os.path.exists(self.full_path):
+        saved = None
+        is_archived = False
+
+        if self.archive is not None:
+            saved = self.archive.load_setlist(self.channel, self.list_date)
+            is_archived = saved is not None
+
+        if saved is None and os.path.exists(self.full_path):
             with open(self.full_path, 'r') as f:
                 saved = json.load(f)
-                self.songs = [Song(s) for s in saved['songs']]
-                self.songs.sort(key=lambda x: x.timestamp)
-                self.has_started = saved.get('has_started', False)
-                self.stream_title = saved.get('stream_title', '')
-                if saved.get('setlist_start', None) is not None:
-                    self.setlist_start = datetime.datetime.fromisoformat(saved['setlist_start'])
+
+        if saved is not None:
+            self.songs = [Song(s) for s in saved['songs']]
+            self.songs.sort(key=lambda x: x.get_sort_key())
+            self.has_started = saved.get('has_started', False)
+            self.stream_title = saved.get('stream_title', '')
+            if saved.get('setlist_start', None) is not None:
+                self.setlist_start = datetime.datetime.fromisoformat(saved['setlist_start'])
+
+        self.rebuild_index()
+
+        if self.replay_journal():
+            self.compact() # start from a clean journal (the last line may have been cut off)
+        elif self.archive is not None and saved is not None and not is_archived:
+            self.archive.save_setlist(self.channel, self.list_date, self.json()) # setlist from before the archive was used
+        elif is_archived:
+            self.save_to_file() # the json file is only written on close so it is stale if the last run did not close
+
+    def replay_journal(self):
+        """
+        Applies the changes in the journal on top of the loaded json file. Returns True if there were any.
+        """
+        if not os.path.exists(self.journal_path):
+            return False
+
+        count = 0
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # partially written line (e.g. crashed while appending)
+
+                self.apply_record(record)
+                count += 1
+
+        return count > 0
+
+    def apply_record(self, record):
+        # records can be applied twice (crash between writing the json file and removing the journal)
+        op = record.get('op')
+
+        if op == 'add':
+            song = Song(record['song'])
+            if self.find_exact(record['song']) is None:
+                self.songs.append(song)
+                self.index.setdefault(get_song_key(song.title, song.artists), []).append(song)
+        elif op == 'touch':
+            song = self.find_exact(record)
+            if song is not None:
+                song.last_timestamp = datetime.datetime.fromisoformat(record['last_timestamp'])
+        elif op == 'remove':
+            song = self.find_exact(record)
+            if song is not None:
+                self.remove_from_index(song)
+                self.songs.remove(song)
+
+    def find_exact(self, ref):
+        """
+        Returns the song matching the title, artists and timestamp (first identification) of the ref dict.
+        """
+        for s in self.index.get(get_song_key(ref['title'], ref['artists']), []):
+            if s.timestamp.isoformat() == ref['timestamp']:
+                return s
+        return None
+
+    def get_ref(self, song):
+        return {'title': song.title, 'artists': song.artists, 'timestamp': song.timestamp.isoformat()}
+
+    def rebuild_index(self):
+        self.index = {}
+        for s in self.songs:
+            self.index.setdefault(get_song_key(s.title, s.artists), []).append(s)
+
+    def find(self, song):
+        """
+        Returns the song already in the list that matches (or None).
+        """
+        matches = self.index.get(get_song_key(song.title, song.artists))
+        return matches[0] if matches else None
 
     def save_to_file(self):
-        with open(self.full_path, "w") as f:
-            f.write(json.dumps(self.json(), indent=4))
+        with self.lock:
+            data = json.dumps(self.json(), indent=4)
+
+        # written to a temp file first so a crash while writing does not corrupt the setlist
+        tmp_path = self.full_path + '.tmp'
+        with open(tmp_path, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.full_path)
+        fsync_dir(self.save_path)
+
+    def persist(self, record):
+        """
+        Saves a change: handed to the write behind thread when enabled, otherwise written right away.
+        """
+        if self.persister is None:
+            self.write_records([record])
+            return
+
+        with self.lock:
+            self.pending_records.append(record)
+        self.persister.mark_dirty()
+
+    def write_pending(self):
+        # runs on the write behind thread
+        with self.lock:
+            records, self.pending_records = self.pending_records, []
+
+        try:
+            self.write_records(records)
+        except Exception:
+            with self.lock:
+                self.pending_records[:0] = records # try again with the next write
+            raise
+
+    def write_records(self, records):
+        """
+        Writes the changes to the archive when used, appends them to the journal when enabled,
+        otherwise the whole json file is saved.
+        """
+        if self.archive is not None:
+            with self.lock:
+                info = self.get_info()
+            self.archive.apply_records(self.channel, self.list_date, records, setlist=info)
+            return
+
+        if not self.use_journal:
+            self.save_to_file()
+            return
+
+        if not os.path.exists(self.full_path):
+            self.compact() # first change of the setlist so also save the setlist info
+
+        with open(self.journal_path, 'a') as f:
+            f.write(''.join(json.dumps(r, separators=(',', ':')) + '\n' for r in records))
+            f.flush()
+            os.fsync(f.fileno())
+
+        if time.monotonic() - self.last_compacted >= self.compact_seconds:
+            self.compact()
+
+    def compact(self):
+        self.save_to_file()
+        if self.archive is not None:
+            with self.lock:
+                setlist = self.json()
+            self.archive.save_setlist(self.channel, self.list_date, setlist)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.last_compacted = time.monotonic()
+
+    def flush(self):
+        """
+        Blocks until every change so far is written to disk.
+        """
+        if self.persister is not None:
+            self.persister.flush()
+
+    def close(self):
+        if self.persister is not None:
+            self.persister.stop()
+            self.persister = None # anything changed after this is written right away
+
+        if self.use_journal or self.archive is not None:
+            self.compact() # the json file is still written for tools that read it
 
     def add(self, song):
-        to_add_title = song.title.lower().translate(str.maketrans('', '', string.punctuation))
-
-        for s in self.songs:
-            title_lower = s.title.lower().translate(str.maketrans('', '', string.punctuation))
-            if title_lower == to_add_title and s.artists == song.artists:
+        with self.lock:
+            s = self.find(song)
+            if s is not None:
                 s.last_timestamp = song.last_timestamp
-                self.save_to_file()
-                return False  # already added so just update last identified date 
-
-        self.songs.append(song)
-        self.save_to_file()
-        return True
+                record = {'op': 'touch', **self.get_ref(s), 'last_timestamp': s.last_timestamp.isoformat()}
+            else:
+                self.songs.append(song)
+                self.index.setdefault(get_song_key(song.title, song.artists), []).append(song)
+                record = {'op': 'add', 'song': song.json()}
+
+        self.persist(record)
+        return s is None # False when already added so just updated last identified date
+
+    def remove(self, song):
+        """
+        Removes the song (or the song at that index) from the list. Returns the removed song.
+        """
+        with self.lock:
+            if isinstance(song, int):
+                song = self.songs.pop(song)
+            else:
+                self.songs.remove(song)
+
+            self.remove_from_index(song)
+
+        self.persist({'op': 'remove', **self.get_ref(song)})
+        return song
+
+    def remove_from_index(self, song):
+        key = get_song_key(song.title, song.artists)
+        matches = self.index.get(key, [])
+        matches[:] = [s for s in matches if s is not song]
+        if len(matches) == 0:
+            self.index.pop(key, None)
+
+    def touch(self, song):
+        # song was heard again without being identified (e.g. no transition detected)
+        with self.lock:
+            song.last_timestamp = datetime.datetime.now()
+        self.persist({'op': 'touch', **self.get_ref(song), 'last_timestamp': song.last_timestamp.isoformat()})
 
     def get_last_song_msg(self, cooldown = 30):
         if len(self.songs) > 0:
@@ -201,6 +474,85 @@ def demo_usage():
     print(p)
     print(str(s))
 
+def demo_index_benchmark(num_songs=10000):
+    # compares the old linear duplicate check with the key index on a large setlist
+    with tempfile.TemporaryDirectory() as tmp:
+        s = SongList(tmp, "benchmark", datetime.datetime.today())
+        s.songs = [Song({'title': f'Song #{i}!', 'artists': [f'Artist {i % 500}'], 'album': ''}) for i in range(num_songs)]
+        s.rebuild_index()
+        lookups = [Song({'title': f'song {i}', 'artists': [f'Artist {i % 500}'], 'album': ''}) for i in range(0, num_songs, 100)]
+
+        def linear_find(song):
+            to_add_title = song.title.lower().translate(str.maketrans('', '', string.punctuation))
+            for x in s.songs:
+                title_lower = x.title.lower().translate(str.maketrans('', '', string.punctuation))
+                if title_lower == to_add_title and x.artists == song.artists:
+                    return x
+            return None
+
+        start = time.perf_counter()
+        linear = [linear_find(song) for song in lookups]
+        linear_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        indexed = [s.find(song) for song in lookups]
+        indexed_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        s.rebuild_index()
+        rebuild_s = time.perf_counter() - start
+
+        assert linear == indexed
+        print(f"{len(lookups)} duplicate checks on {num_songs} songs")
+        print(f"linear: {linear_s * 1000:.1f} ms ({linear_s / len(lookups) * 1e6:.1f} us per check)")
+        print(f"indexed: {indexed_s * 1000:.1f} ms ({indexed_s / len(lookups) * 1e6:.1f} us per check)")
+        print(f"index rebuild (load): {rebuild_s * 1000:.1f} ms")
+
+class LegacySong:
+    # Song before __slots__ and lazy timestamps (only kept to compare against in the benchmarks below)
+    def __init__(self, info):
+        self.title = info['title']
+        self.album = info['album']
+        self.artists = info['artists']
+        self.duration_s = info.get('duration_s', 0)
+        self.added_by = info.get('added_by', '')
+        self.was_found = info.get('was_found', False)
+        self.last_timestamp = datetime.datetime.fromisoformat(info['last_timestamp'])
+        self.timestamp = datetime.datetime.fromisoformat(info['timestamp'])
+
+def get_benchmark_songs(num_songs):
+    start = datetime.datetime(2023, 1, 1, 20, 0)
+    return [{'title': f'Song #{i}', 'album': f'Album {i % 300}', 'artists': [f'Artist {i % 500}'], 'duration_s': 240,
+             'timestamp': (start + datetime.timedelta(minutes=4 * i)).isoformat(),
+             'last_timestamp': (start + datetime.timedelta(minutes=4 * i + 2)).isoformat(),
+             'added_by': '', 'was_found': False} for i in range(num_songs)]
+
+def demo_load_benchmark(num_songs=100000):
+    # time to build (and sort) the songs of a year of setlists
+    saved = get_benchmark_songs(num_songs)
+
+    for cls, key in [(LegacySong, lambda x: x.timestamp), (Song, lambda x: x.get_sort_key())]:
+        start = time.perf_counter()
+        songs = [cls(s) for s in saved]
+        songs.sort(key=key)
+        print(f"{cls.__name__}: loaded {num_songs} songs in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    songs = [Song(s) for s in saved[:100]]
+    assert [s.json() for s in songs] == saved[:100] # json() output is unchanged
+
+def demo_memory_benchmark(num_songs=100000):
+    import tracemalloc
+
+    saved = get_benchmark_songs(num_songs)
+
+    for cls in [LegacySong, Song]:
+        tracemalloc.start()
+        songs = [cls(s) for s in saved]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{cls.__name__}: {size / 1024 / 1024:.1f} MB for {num_songs} songs ({size / num_songs:.0f} bytes per song)")
+        del songs
+
 def print_setlist_tabular():
     today = datetime.date.today()
     setlist = SongList("F:\\twitch", "myanalogjournal_",
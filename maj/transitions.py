@@ -0,0 +1,149 @@
+import time
+import logging
+import numpy as np
+from maj.utils.audio import get_frame_db
+
+log = logging.getLogger(__name__)
+
+FRAME_SIZE = 1024 # ~128ms at 8kHz
+HOP_SIZE = 512
+MIN_FREQ = 55.0 # A1, lowest note used for chroma
+MAX_FREQ = 4000.0
+NUM_BANDS = 24 # log spaced bands used to compare the overall timbre of two samples
+FLUX_FLOOR = 0.1
+MIN_GAP_SECONDS = 0.5 # quiet time inside a sample that counts as a gap between songs
+
+
+def get_spectrogram(pcm, sample_rate, frame_size=FRAME_SIZE, hop_size=HOP_SIZE):
+    """
+    Returns (magnitudes, bin frequencies) where magnitudes has one row per frame.
+    """
+    x = pcm.astype(np.float32) / 32768.0
+    if len(x) < frame_size:
+        x = np.pad(x, (0, frame_size - len(x)))
+
+    num_frames = 1 + (len(x) - frame_size) // hop_size
+    idx = np.arange(frame_size)[None, :] + hop_size * np.arange(num_frames)[:, None]
+    frames = x[idx] * np.hanning(frame_size)[None, :].astype(np.float32)
+
+    mags = np.abs(np.fft.rfft(frames, axis=1))
+    freqs = np.fft.rfftfreq(frame_size, 1.0 / sample_rate)
+    return mags, freqs
+
+
+def get_chroma_filter(freqs):
+    """
+    Matrix (12 x bins) that sums fft bins into the 12 pitch classes.
+    """
+    chroma_filter = np.zeros((12, len(freqs)), dtype=np.float32)
+    valid = (freqs >= MIN_FREQ) & (freqs <= MAX_FREQ)
+    pitch_class = np.round(69 + 12 * np.log2(freqs[valid] / 440.0)).astype(int) % 12
+    chroma_filter[pitch_class, np.nonzero(valid)[0]] = 1.0
+    return chroma_filter
+
+
+def get_band_filter(freqs, num_bands=NUM_BANDS):
+    edges = np.geomspace(MIN_FREQ, min(MAX_FREQ, freqs[-1]), num_bands + 1)
+    band = np.searchsorted(edges, freqs) - 1
+    band_filter = np.zeros((num_bands, len(freqs)), dtype=np.float32)
+    valid = (band >= 0) & (band < num_bands)
+    band_filter[band[valid], np.nonzero(valid)[0]] = 1.0
+    return band_filter
+
+
+def compute_features(pcm, sample_rate):
+    """
+    Per frame rms energy plus the average spectral flux, chroma and band energy of the sample.
+    """
+    mags, freqs = get_spectrogram(pcm, sample_rate)
+
+    rms_db = get_frame_db(pcm, sample_rate, frame_ms=1000 * HOP_SIZE / sample_rate)
+
+    # spectral flux = how much the (normalized) spectrum increased since the previous frame
+    norm = mags / (np.sum(mags, axis=1, keepdims=True) + 1e-10)
+    flux = np.sum(np.maximum(np.diff(norm, axis=0), 0), axis=1)
+
+    chroma = mags @ get_chroma_filter(freqs).T
+    chroma = chroma / (np.sum(chroma, axis=1, keepdims=True) + 1e-10)
+
+    bands = np.log1p(mags @ get_band_filter(freqs).T)
+
+    return {'sample_rate': sample_rate,
+            'rms_db': rms_db,
+            'flux': float(np.mean(flux)) if len(flux) > 0 else 0.0,
+            'chroma': np.mean(chroma, axis=0),
+            'bands': np.mean(bands, axis=0)}
+
+
+def cosine_distance(a, b):
+    denom = np.linalg.norm(a) * np.linalg.norm(b)
+    if denom == 0:
+        return 1.0
+    return 1.0 - float(np.dot(a, b) / denom)
+
+
+class TransitionDetector:
+    """
+    Compares each recorded sample to the previous one to guess if a new song started,
+    so ACR is only called when the song likely changed (or max_interval has passed).
+    """
+
+    def __init__(self, threshold=0.2, silence_db=-45, max_interval=300):
+        self.threshold = threshold # combined chroma/timbre/flux distance that counts as a different song
+        self.silence_db = silence_db # a gap quieter than this inside a sample is treated as a transition
+        self.max_interval = max_interval # always identify after this many seconds
+
+        self.last_features = None
+        self.last_identified = 0
+        self.last_found = False
+
+    def get_distance(self, prev, cur):
+        # flux is compared relative to the larger of the two (floor keeps near-static audio from looking different)
+        flux_distance = abs(prev['flux'] - cur['flux']) / (max(prev['flux'], cur['flux']) + FLUX_FLOOR)
+
+        return 0.4 * cosine_distance(prev['chroma'], cur['chroma']) + \
+               0.4 * cosine_distance(prev['bands'], cur['bands']) + \
+               0.2 * flux_distance
+
+    def has_internal_transition(self, features):
+        rms_db = features['rms_db']
+        loud = rms_db > self.silence_db
+
+        # a quiet gap between two loud parts of the sample
+        if np.any(loud) and not np.all(loud):
+            first, last = np.nonzero(loud)[0][[0, -1]]
+            quiet_seconds = np.sum(~loud[first:last]) * HOP_SIZE / features['sample_rate']
+            if quiet_seconds >= MIN_GAP_SECONDS:
+                return True
+
+        return False
+
+    def is_transition(self, pcm, sample_rate):
+        features = compute_features(pcm, sample_rate)
+        prev = self.last_features
+        self.last_features = features
+
+        if prev is None:
+            return True
+
+        distance = self.get_distance(prev, features)
+        internal = self.has_internal_transition(features)
+        log.debug(f"transition distance: {distance:.3f} internal: {internal}")
+
+        return distance > self.threshold or internal
+
+    def should_identify(self, pcm, sample_rate):
+        # always compute features so the next sample is compared against this one
+        changed = self.is_transition(pcm, sample_rate)
+
+        if not self.last_found:
+            return True # nothing is known about the current song yet
+
+        if time.monotonic() - self.last_identified >= self.max_interval:
+            return True
+
+        return changed
+
+    def mark_identified(self, found):
+        self.last_identified = time.monotonic()
+        self.last_found = found
@@ -3,13 +3,14 @@ import pathlib
 import datetime
 import json
 import asyncio
+import time
 import random
 import logging
 from time import sleep
 from twitchio.ext import commands
 from twitchio.dataclasses import Message
-from maj.identifier import Identifier
-from maj.twitchrecorder import TwitchRecorder
+from maj.identifier import Identifier, QuotaExceeded, PRIORITY_USER, PRIORITY_BACKGROUND
+from maj.twitchrecorder import TwitchRecorder, RecordingStatus
 from maj.songlist import Song, SongList
 from maj.vpnrotator import VpnRotator
 from maj.discordbot import MajBotClient
@@ -17,6 +18,9 @@ from maj.pollvote import MajPoll
 from maj.utils import botreplys
 from maj.utils.spotifyclient import SpotifyClient
 from maj.utils.chatgpt import ChatGPTBot
+from maj.utils.audio import decode_pcm, ACR_SAMPLE_RATE
+from maj.scheduler import IdentifyScheduler
+from maj.retrypolicy import RetryPolicy
 
 log = logging.getLogger(__name__)
 
@@ -31,6 +35,10 @@ class TwitchBot(commands.Bot):
         self.twitch_recorder = recorder
         self.music_identifier = identifier
         self.vpn = kwargs.get("vpn", None)
+        self.preprocessor = kwargs.get("preprocessor", None)
+        self.transition_detector = kwargs.get("transition_detector", None)
+        self.schedule = kwargs.get("schedule", None)
+        self.demand = kwargs.get("demand", None)
 
         chatgpt_key = kwargs.get("chatgpt_key", None)
         self.chatgpt_bot = None
@@ -41,15 +49,22 @@ class TwitchBot(commands.Bot):
         self.maj_poll = None
         self.prev_polls = []
         self.has_greeted = False
-        self.is_identifying = False
+        self.identify_scheduler = IdentifyScheduler() # every identification runs through this one at a time
         self.is_silenced = True
-        self.trigger_count = 0
+        self.track_flight = None # in progress identification (auto-id, early or !track) that !track requests join
+        self.track_requesters = [] # names of everyone waiting on track_flight
         self.try_count = 0
         self.max_trys = 10
+        self.record_failure = None # why the last record_sample failed (RetryPolicy kind)
+        self.identify_failure = None # why the last identify_sample failed (RetryPolicy kind)
 
         self.last_msg = ""
         self.last_msg_sent = datetime.datetime.now()
 
+    @property
+    def is_identifying(self):
+        return self.identify_scheduler.is_identifying
+
     async def event_ready(self):
         """
         Called once when the bot goes online.
@@ -72,6 +87,7 @@ class TwitchBot(commands.Bot):
             return
 
         if botreplys.get_intent_tag(message.content) == "identify":
+            self.note_demand("intent")
             ctx = await self.get_context(message)
             await self.send_lastsong_message(ctx, message.content) 
             
@@ -93,16 +109,57 @@ class TwitchBot(commands.Bot):
     def is_bot_mentioned(self, message):
         return self.config['botUsername'].lower() in message.lower()
 
-    @commands.command(name='track', aliases=['playing', 'tune', 'TRACK', 'thong', 'song'])
-    async def track(self, ctx):
+    def note_demand(self, kind, can_start=True):
+        """
+        Counts a viewer asking what is playing and starts identifying early when enough have asked.
+        can_start is False when the caller is about to start identifying itself.
+        """
+        if self.demand is None or not self.demand.record(kind):
+            return
+
+        if self.identify_scheduler.is_cooling_down:
+            self.identify_scheduler.wake() # cut the auto-id cooldown short
+        elif can_start and not self.is_identifying and self.track_flight is None:
+            log.info("identifying early because chat is asking ...")
+            # started as the shared flight so a !track sent meanwhile joins it instead of identifying again
+            self.track_requesters = []
+            self.start_track_flight('speculative', self.try_identify, only_on_change=True, priority=PRIORITY_BACKGROUND, requesters=self.track_requesters)
+
+    def start_track_flight(self, kind, func, *args, **kwargs):
+        # the task is kept in track_flight until it is done
+        self.track_flight = asyncio.ensure_future(self.run_track_flight(kind, func, *args, **kwargs))
+        return self.track_flight
+
+    async def auto_identify(self):
+        """
+        Runs one auto-id check as the shared flight so a !track sent meanwhile is mentioned in its reply.
+        """
+        if self.track_flight is not None:
+            return await asyncio.shield(self.track_flight) # already identifying so no need to check again
 
-        self.trigger_count += 1
-        if self.trigger_count >= 5:
-            self.trigger_count = 0 # reset count so message sent every 5 times someone sends '!track' 
-            await self.send_message(ctx, botreplys.get_already_listening_reply())
+        self.track_requesters = []
+        return await self.start_track_flight('auto', self.try_identify, only_on_change=True, priority=PRIORITY_BACKGROUND, requesters=self.track_requesters)
 
-        if self.is_identifying:
-            log.info('already trying to identify!')
+    async def run_track_flight(self, kind, func, *args, **kwargs):
+        try:
+            return await self.identify_scheduler.run(kind, func, *args, **kwargs)
+        except Exception as e:
+            log.error(f"{kind} identification failed: {e}")
+            return False
+        finally:
+            self.track_flight = None
+            self.track_requesters = []
+
+    @commands.command(name='track', aliases=['playing', 'tune', 'TRACK', 'thong', 'song'])
+    async def track(self, ctx):
+        requester = ctx.author.name
+        self.note_demand("track", can_start=False) # !track either joins, answers or identifies below
+
+        if self.track_flight is not None:
+            # join the identification in progress and get mentioned in its reply
+            if requester not in self.track_requesters:
+                self.track_requesters.append(requester)
+            log.info(f'{requester} joined the identification in progress ({len(self.track_requesters)} waiting)')
             return
 
         if self.config.get("identifyCooldown", 30) > 0:
@@ -118,35 +175,125 @@ class TwitchBot(commands.Bot):
                 await self.send_lastsong_message(ctx, ctx.content) 
                 return
 
-        found = False
-        self.try_count = 0
-        self.is_identifying = True
+        self.track_requesters = [requester]
+        found = await self.start_track_flight('manual', self.identify_pipelined, ctx, max_attempts=5)
 
-        while found is False and self.try_count < 5:
-            found = await self.try_identify(ctx)
-            await asyncio.sleep(5)
-            self.try_count += 1
-        
-        self.is_identifying = False
         if not found:
             log.info('exceeded number of retrys ...')
 
+    async def identify_pipelined(self, ctx, max_attempts=5):
+        """
+        Records the next sample while the previous one is being identified (connected by a
+        bounded queue) and cancels any remaining recordings once a song is found.
+        With 'progressiveSeconds' set, short prefixes of the recording in progress are identified
+        first and the same recording keeps going (for a longer sample) only if they do not match.
+        """
+        samples = asyncio.Queue(maxsize=1)
+        checkpoints = self.config.get('progressiveSeconds', [])
+        policy = RetryPolicy(self.config.get('retryPolicy', {}))
+
+        def put_prefix(prefix_path):
+            try:
+                samples.put_nowait((prefix_path, True))
+            except asyncio.QueueFull:
+                os.remove(prefix_path) # still identifying an earlier sample so wait for the longer one
+
+        async def produce():
+            next_sample_at = 0.0
+
+            for attempt in range(max_attempts):
+                await policy.wait()
+
+                # a buffered sample is taken instantly so wait for new audio instead of sending the same audio again
+                delay = next_sample_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                self.try_count = attempt + 1
+                file_path = await self.record_sample(ctx, checkpoints=checkpoints, on_checkpoint=put_prefix if len(checkpoints) > 0 else None)
 
-    async def try_identify(self, ctx = None):
+                if self.twitch_recorder.used_buffer:
+                    next_sample_at = time.monotonic() + self.config.get('recordLength', 15)
+
+                if file_path is not None:
+                    await samples.put((file_path, False))
+                elif not policy.on_failure(self.record_failure):
+                    break
+
+            await samples.put(None) # no more samples
+
+        producer = asyncio.create_task(produce())
+        found = False
 
         try:
-            if not self.twitch_recorder.is_user_online():
-                log.warning(f"can not record because {self.config['channel']} is not online")
-                return False
+            while not found:
+                item = await samples.get()
+                if item is None:
+                    break
+
+                file_path, is_prefix = item
+                found = await self.identify_sample(ctx, file_path, requesters=self.track_requesters, is_prefix=is_prefix)
 
-            self.is_identifying = True
+                if not found and self.identify_failure is not None and not policy.on_failure(self.identify_failure):
+                    break
+        finally:
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+
+            # prefixes that were handed out but never identified
+            while not samples.empty():
+                item = samples.get_nowait()
+                if item is not None and item[1] and os.path.exists(item[0]):
+                    os.remove(item[0])
+
+        if not found:
+            log.info(f"identification failures: {policy.get_failures()}")
+
+        return found
+
+    async def try_identify(self, ctx = None, only_on_change = False, priority = PRIORITY_USER, requesters = None):
+        if ctx is None:
+            ctx = await self.get_context(Message(channel=self.get_channel(self.config['channel']), content="", author=self.config['botUsername'], raw_data="", tags={}))
+
+        found = False
+        file_path = await self.record_sample(ctx)
 
+        if file_path is not None:
+            found = await self.identify_sample(ctx, file_path, only_on_change=only_on_change, priority=priority, requesters=requesters)
 
-            if ctx is None:
-                ctx = await self.get_context(Message(channel=self.get_channel(self.config['channel']), content="", author=self.config['botUsername'], raw_data="", tags={}))
+        return found
+
+    async def record_sample(self, ctx, checkpoints=(), on_checkpoint=None):
+        """
+        Records a sample of the stream (switching vpn and trying again when blocked).
+        Returns the path of the recording or None if nothing (unblocked) could be recorded (see record_failure).
+        """
+        self.record_failure = None
+
+        try:
+            if not await self.twitch_recorder.is_user_online():
+                log.warning(f"can not record because {self.config['channel']} is not online")
+                self.record_failure = RetryPolicy.OFFLINE
+                return None
 
             record_length = self.config.get('recordLength', 15)
-            file_path = await self.twitch_recorder.record(record_length)
+            file_path = await self.twitch_recorder.record(record_length, checkpoints=checkpoints, on_checkpoint=on_checkpoint)
+
+            if self.twitch_recorder.last_status == RecordingStatus.OFFLINE:
+                log.warning(f"stopped recording because {self.config['channel']} is offline")
+                self.twitch_recorder.channel_status.invalidate()
+                self.record_failure = RetryPolicy.OFFLINE
+                return None
+
+            if self.twitch_recorder.last_status == RecordingStatus.AD_BREAK:
+                log.warning("stopped recording because an ad break is playing ...")
+                await self.send_message(ctx, botreplys.get_trouble_listening_reply(), force_quiet=self.is_silenced)
+                self.record_failure = RetryPolicy.BLOCKED
+                return None
+
             if self.twitch_recorder.is_blocked:
                 log.warning("recording blocked and could not download ...")
 
@@ -164,38 +311,104 @@ class TwitchBot(commands.Bot):
                 if self.twitch_recorder.is_blocked:
                     log.warning("recording blocked again ...")
 
+            if self.twitch_recorder.is_blocked and file_path is not None:
+                # a blocked recording will not match so it is not worth an ACR request
+                asyncio.get_running_loop().run_in_executor(None, self.twitch_recorder.sample_store.release, file_path)
+                self.record_failure = RetryPolicy.BLOCKED
+                file_path = None
+
         except Exception as e:
             log.error(e)
             self.twitch_recorder.is_recording = False
+            self.record_failure = RetryPolicy.NETWORK
             file_path = None
 
         if file_path is None or not os.path.exists(file_path):
             await self.send_message(ctx, botreplys.get_trouble_listening_reply(), force_quiet=self.is_silenced)
-            self.is_identifying = False
-            return False
+            if self.record_failure is None:
+                self.record_failure = RetryPolicy.BLOCKED
+            return None
+
+        return file_path
+
+    async def identify_sample(self, ctx, file_path, only_on_change = False, priority = PRIORITY_USER, requesters = None, is_prefix = False):
+        """
+        Identifies a recorded sample and replies with the song. Returns True if the song is known.
+        When requesters is given they are all mentioned in a single reply (even if the song was already added).
+        A prefix (of a recording still in progress) is deleted afterwards and does not reply when unknown.
+        Sets identify_failure (RetryPolicy kind) when the song is not known.
+        """
+        self.identify_failure = None
+
+        if only_on_change and self.transition_detector is not None and len(self.playlist.songs) > 0:
+            try:
+                pcm = await asyncio.get_running_loop().run_in_executor(None, decode_pcm, file_path)
+                is_changed = self.transition_detector.should_identify(pcm, ACR_SAMPLE_RATE)
+            except Exception as e:
+                log.error(e)
+                is_changed = True
+
+            if not is_changed:
+                log.info("no song change detected. skipping identification ...")
+                self.playlist.touch(self.playlist.songs[-1]) # same song so it is still currently playing
+                asyncio.get_running_loop().run_in_executor(None, self.twitch_recorder.sample_store.release, file_path)
+                if requesters:
+                    await self.send_message(ctx, f"{botreplys.get_mentions(requesters)} {self.playlist.songs[-1].get_current_playing_msg()}")
+                return True
+
+        upload_path = file_path
 
         try:
-            response = self.music_identifier.identify(file_path)
-            info = self.music_identifier.get_song_info_from_response(response)
+            if self.preprocessor is not None:
+                upload_path = await asyncio.get_running_loop().run_in_executor(None, self.preprocessor.process, file_path)
+
+            info = await self.music_identifier.get_song_info(upload_path, priority=priority)
+        except QuotaExceeded as e:
+            log.warning(e)
+            self.identify_failure = RetryPolicy.QUOTA
+            info = None
         except Exception as e:
             log.error(e)
-            self.music_identifier.is_identifying = False
+            self.identify_failure = RetryPolicy.NETWORK
             info = None
 
+        if upload_path != file_path and os.path.exists(upload_path):
+            os.remove(upload_path)
+
+        if self.transition_detector is not None:
+            self.transition_detector.mark_identified(info is not None)
+
+        if is_prefix:
+            os.remove(file_path) # the full recording is kept instead
+        else:
+            # sample is not needed anymore so let the store compact/evict in the background
+            asyncio.get_running_loop().run_in_executor(None, self.twitch_recorder.sample_store.release, file_path)
+
+        if info is None and is_prefix:
+            log.info("no match on the short sample. waiting for the longer one ...")
+            return False # not counted as a failure since the longer sample is still coming
+
+        if info is None and self.identify_failure is None:
+            self.identify_failure = RetryPolicy.NO_MATCH
+
         if info is None:
-            msg = botreplys.get_trouble_listening_reply() if self.twitch_recorder.is_blocked else botreplys.get_unknown_song_reply()
+            msg = botreplys.get_unknown_song_reply()
+            if requesters:
+                msg = f"{botreplys.get_mentions(requesters)} {msg}"
             await self.send_message(ctx, msg, force_quiet=self.is_silenced)
-            self.is_identifying = False
             return False
             
+        if self.schedule is not None:
+            self.schedule.update(info)
+
         song = Song(info)
         was_added = self.playlist.add(song)
-        if was_added:
+        if was_added or requesters:
             msg = song.get_current_playing_msg()
+            if requesters:
+                msg = f"{botreplys.get_mentions(requesters)} {msg}"
             await self.send_message(ctx, msg)
-        
-        self.is_identifying = False
-        self.trigger_count = 0
+
         return True
 
     @commands.command(name='majhelp', aliases=['bothelp'])
@@ -251,7 +464,7 @@ class TwitchBot(commands.Bot):
         # remove song only if added in past 2 minutes or keyword 'force' is used
         elapsedTime = datetime.datetime.now() - song.last_timestamp
         if elapsedTime.total_seconds() < 120 or 'force' in chat_msgs:
-            self.playlist.songs.pop(idx)
+            self.playlist.remove(idx)
             msg = f'Removed: "{song.title}" ║ Artist: {", ".join(song.artists)}'
             await self.send_message(ctx, msg)
 
@@ -277,8 +490,8 @@ class TwitchBot(commands.Bot):
         # remove song only if added in past 2 minutes or keyword 'force' is used
         elapsedTime = datetime.datetime.now() - song.last_timestamp
         if elapsedTime.total_seconds() < 120 or 'force' in chat_msgs:
-            self.playlist.songs.pop(idx)
-            msg = f'Removed: "{song.title}" ║ Artist: {", ".join(song.artists)}  ║ Album: {self.album}'
+            self.playlist.remove(idx)
+            msg = f'Removed: "{song.title}" ║ Artist: {", ".join(song.artists)}  ║ Album: {song.album}'
             await self.send_message(ctx, msg)
 
 
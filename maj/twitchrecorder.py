@@ -2,7 +2,6 @@
 # You can read more details at: https://www.junian.net/2017/01/how-to-record-twitch-streams.html
 # original code is from https://slicktechies.com/how-to-watchrecord-twitch-streams-using-livestreamer/
 
-import requests
 import os
 import time
 import json
@@ -12,46 +11,288 @@ import datetime
 import getopt
 import asyncio
 import logging
+import shutil
+import threading
+import collections
+import urllib.parse
 from streamlink import Streamlink
+
+try:
+    from streamlink.options import Options # plugin options are passed to session.streams() since streamlink 6
+except ImportError:
+    Options = None
 from maj.vpnrotator import VpnRotator
+from maj.samplestore import SampleStore
+from maj.utils.helix import HelixClient
+from maj.channelstatus import ChannelStatus
 
 log = logging.getLogger(__name__)
 
 SIZE_THRESHOLD = 1000000 # size of file in bytes (when to stop recording)
+BUFFER_CHUNK_SIZE = 8192 # bytes read from the stream at a time when buffering
+TS_PACKET_SIZE = 188 # audio_only stream is sent as mpeg-ts packets
+READ_CHUNK_SIZE = 16384 # bytes read from the streamlink stdout pipe at a time
+STARTUP_SECONDS = 5 # time allowed for the streamlink process to start and load the stream
+AUDIO_BYTES_PER_SECOND = 22000 # approx. bitrate of the audio_only stream (~160kbps aac + ts overhead)
+PROBE_SECONDS = 2 # time after the first byte used to check if the recording is healthy
+LIVE_EDGE_SECONDS = 6 # streamlink downloads the last 3 (2 second) segments right away
+MAX_RATE_FACTOR = 2 # more than this times the expected audio rate means we are not getting audio only
+
+# streamlink log messages used to classify a failed recording
+OFFLINE_MESSAGES = ["no playable streams found", "is offline", "stream is not available"]
+BLOCKED_MESSAGES = ["403 client error", "forbidden", "unable to open url", "failed to reload playlist", "could not open stream"]
+AD_BREAK_MESSAGES = ["detected advertisement break", "waiting for pre-roll ads", "pausing stream output"]
+
+
+STALE_URL_MESSAGES = ["403 client error", "404 client error"]
+URL_EXPIRY_MARGIN = 60 # seconds before the access token expires to stop using a cached url
+BUFFER_STALE_SECONDS = 4 # nothing received by the buffer for this long means output is paused (e.g. ad break)
+MIN_BUFFER_FILL = 0.5 # a buffered sample with less than this fraction of the expected audio is not used
+
+
+class RecordingStatus:
+    HEALTHY = "healthy"
+    BLOCKED = "blocked"
+    OFFLINE = "offline"
+    AD_BREAK = "ad_break"
+
+
+def classify_streamlink_message(msg):
+    msg = msg.lower()
+
+    if any(m in msg for m in OFFLINE_MESSAGES):
+        return RecordingStatus.OFFLINE
+    if any(m in msg for m in AD_BREAK_MESSAGES):
+        return RecordingStatus.AD_BREAK
+    if any(m in msg for m in BLOCKED_MESSAGES):
+        return RecordingStatus.BLOCKED
+
+    return None
+
+
+class StreamBuffer:
+    """
+    Keeps the last N seconds of the live stream in memory so a sample can be taken instantly
+    instead of starting a new streamlink process for every recording.
+    """
+
+    def __init__(self, session, url, quality, max_seconds, reconnect_delay=5.0, plugin_options=None):
+        self.session = session
+        self.url = url
+        self.quality = quality
+        self.max_seconds = max_seconds
+        self.reconnect_delay = reconnect_delay
+        self.plugin_options = plugin_options
+
+        self.chunks = collections.deque() # (time received, bytes)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.fd = None
+        self.is_running = False
+
+    def start(self):
+        if self.is_running:
+            return
+
+        self.is_running = True
+        self.thread = threading.Thread(target=self._read_stream, name="StreamBuffer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+
+        # closing the stream unblocks the read in the buffer thread
+        if self.fd is not None:
+            try:
+                self.fd.close()
+            except Exception as e:
+                log.debug(e)
+
+        if self.thread is not None:
+            self.thread.join(timeout=self.reconnect_delay)
+            self.thread = None
+
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.chunks.clear()
+
+    def get_buffered_seconds(self):
+        with self.lock:
+            if len(self.chunks) == 0:
+                return 0
+            return self.chunks[-1][0] - self.chunks[0][0]
+
+    def get_seconds_since_received(self):
+        with self.lock:
+            if len(self.chunks) == 0:
+                return None
+            return time.monotonic() - self.chunks[-1][0]
+
+    def get_sample(self, length):
+        """
+        Returns the bytes received in the last `length` seconds (aligned to the first mpeg-ts packet).
+        """
+        with self.lock:
+            if len(self.chunks) == 0:
+                return b''
+
+            start_time = self.chunks[-1][0] - length
+            data = b''.join(c for t, c in self.chunks if t >= start_time)
+
+        return data[find_ts_sync(data):]
+
+    def _append(self, data):
+        now = time.monotonic()
+
+        with self.lock:
+            self.chunks.append((now, data))
+
+            # drop anything older than the max buffer length
+            while len(self.chunks) > 0 and now - self.chunks[0][0] > self.max_seconds:
+                self.chunks.popleft()
+
+    def _read_stream(self):
+        while self.is_running:
+            try:
+                if self.plugin_options is not None:
+                    streams = self.session.streams(self.url, options=self.plugin_options)
+                else:
+                    streams = self.session.streams(self.url)
+                stream = streams.get(self.quality)
+
+                if stream is None:
+                    log.warning(f"no '{self.quality}' stream found for {self.url}")
+                else:
+                    self.fd = stream.open()
+                    log.info(f"buffering {self.url} ...")
+
+                    while self.is_running:
+                        data = self.fd.read(BUFFER_CHUNK_SIZE)
+                        if not data:
+                            break # stream ended
+                        self._append(data)
+
+            except Exception as e:
+                log.error(f"stream buffer error: {e}")
+            finally:
+                if self.fd is not None:
+                    try:
+                        self.fd.close()
+                    except Exception as e:
+                        log.debug(e)
+                    self.fd = None
+
+            # samples should not span across a reconnect
+            self.clear()
+
+            if self.is_running:
+                time.sleep(self.reconnect_delay)
+
+
+def find_ts_sync(data):
+    """
+    Returns the index of the first mpeg-ts packet in data (or 0 if it can not be found).
+    """
+    for i in range(min(TS_PACKET_SIZE, len(data))):
+        if data[i] == 0x47 and (i + TS_PACKET_SIZE >= len(data) or data[i + TS_PACKET_SIZE] == 0x47):
+            return i
+    return 0
+
+class StreamUrlCache:
+    """
+    Caches the resolved hls url (which has the twitch access token embedded) for each channel
+    so repeated recordings can skip fetching the token and master playlist.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl # max seconds an entry is used even if the token expires later
+        self.entries = {} # channel -> (url, expires_at)
+
+    def get(self, channel):
+        entry = self.entries.get(channel)
+        if entry is None:
+            return None
+
+        url, expires_at = entry
+        if time.time() >= expires_at:
+            log.debug(f"cached stream url for {channel} expired")
+            del self.entries[channel]
+            return None
+
+        return url
+
+    def set(self, channel, url, token_url=None):
+        expires_at = time.time() + self.ttl
+
+        token_expires = get_token_expiration(token_url or url)
+        if token_expires is not None:
+            expires_at = min(expires_at, token_expires - URL_EXPIRY_MARGIN)
+
+        self.entries[channel] = (url, expires_at)
+
+    def invalidate(self, channel):
+        if self.entries.pop(channel, None) is not None:
+            log.info(f"invalidated cached stream url for {channel}")
+
+
+def get_token_expiration(url):
+    """
+    Returns the 'expires' epoch of the access token in a twitch usher url (or None if not found).
+    """
+    try:
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        token = json.loads(query['token'][0])
+        return float(token['expires'])
+    except Exception:
+        return None
+
 
 class TwitchRecorder:
-    def __init__(self, client_id, client_secret, username, root_path, quality='audio_only'):
+    def __init__(self, client_id, client_secret, username, root_path, quality='audio_only', buffer_seconds=0, url_cache_seconds=0, store_options=None, status_cache_seconds=60):
         self.client_id = client_id
         self.client_secret = client_secret
+        self.helix = HelixClient(client_id)
+        self.channel_status = ChannelStatus(self.fetch_user, ttl=status_cache_seconds)
         self.oauth_token = ""
         self.expiration_date = None
         self.refresh = 5.0
         self.root_path = root_path
         self.is_recording = False
         self.is_blocked = False
+        self.last_status = None # RecordingStatus of the last recording
         
         self.username = username
         self.quality = quality
 
+        # when > 0 the stream is continuously buffered in memory and samples are taken from it
+        self.buffer_seconds = buffer_seconds
+        self.stream_buffer = None
+        self.used_buffer = False # last sample was taken from the buffer (so it ends now instead of being recorded)
+
+        # used to decide when enough audio has been recorded
+        self.bytes_per_second = AUDIO_BYTES_PER_SECOND
+
+        # when > 0 the resolved stream url is reused for this many seconds (at most)
+        self.url_cache = StreamUrlCache(url_cache_seconds) if url_cache_seconds > 0 else None
+        self.used_cached_url = False
+
+        # limits for the recorded samples ('maxMegabytes', 'maxAgeDays', 'codec')
+        self.store_options = store_options or {}
+        self.sample_store = None
+
         self.init_paths()
 
-    def authorize(self, saved_token, saved_expiration):
+    async def authorize(self, saved_token, saved_expiration):
         self.oauth_token = saved_token
         self.expiration_date = datetime.date.fromisoformat(saved_expiration)
 
         if datetime.date.today() < self.expiration_date:
             return False # token not expired so no need to refresh it
 
-        body = {
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-            "grant_type": 'client_credentials'
-        }
-
         try:
-            r = requests.post('https://id.twitch.tv/oauth2/token', body)
-
-            keys = r.json()
+            keys = await self.helix.get_app_token(self.client_secret)
 
             expires_in = keys.get('expires_in', 0) # this is in seconds
 
@@ -70,72 +311,309 @@ class TwitchRecorder:
         if(os.path.isdir(self.recorded_path) is False):
             os.makedirs(self.recorded_path)
 
-    def is_user_online(self):
-        return self.get_user() is not None
+        self.sample_store = SampleStore(self.recorded_path,
+                                        max_bytes=int(self.store_options.get('maxMegabytes', 0) * 1024 * 1024),
+                                        max_age_days=self.store_options.get('maxAgeDays', 0),
+                                        codec=self.store_options.get('codec'))
 
-    def get_user(self):
-        headers = {
-            'Client-ID': self.client_id,
-            'Authorization': 'Bearer ' + self.oauth_token
-        }
+    async def is_user_online(self):
+        return await self.channel_status.is_online()
 
-        stream = requests.get('https://api.twitch.tv/helix/streams?user_login=' + self.username, headers=headers)
-        stream_json = stream.json()
+    async def get_user(self):
+        return await self.channel_status.get_stream()
 
+    async def fetch_user(self):
+        streams = await self.helix.get_streams(self.oauth_token, self.username)
 
-        if len(stream_json['data']) == 1:
-            return stream_json['data'][0]
+        if len(streams) == 1:
+            return streams[0]
         else:
             return None
 
-    def get_stream_title(self):
-        user = self.get_user()
-        if user is not None:
-            return user.get('title', '')
-        else:
-            return ''
+    async def get_stream_title(self):
+        return await self.channel_status.get_title()
+
+    async def close(self):
+        await self.helix.close()
+
+    def create_session(self):
+        session = Streamlink()
+        session.set_option("http-headers", {
+            "Authorization": "Bearer " + self.oauth_token,
+            "Client-Id": self.client_id,
+            "Origin": "https://www.twitch.tv"
+        })
+
+        # same as --twitch-disable-ads on the command line (streamlink < 6 sets it on the session)
+        if hasattr(session, 'set_plugin_option'):
+            session.set_plugin_option("twitch", "disable-ads", True)
+        return session
+
+    def create_plugin_options(self, session):
+        if hasattr(session, 'set_plugin_option') or Options is None:
+            return None # already set on the session
+        return Options({"disable-ads": True})
+
+    def start_buffer(self):
+        if self.buffer_seconds <= 0:
+            return False # buffering disabled
+
+        if self.stream_buffer is None:
+            session = self.create_session()
+            self.stream_buffer = StreamBuffer(session, "twitch.tv/" + self.username, self.quality, self.buffer_seconds,
+                                              plugin_options=self.create_plugin_options(session))
+
+        self.stream_buffer.start()
+        return True
+
+    def stop_buffer(self):
+        if self.stream_buffer is not None:
+            self.stream_buffer.stop()
+            self.stream_buffer = None
+
+    def resolve_stream_url(self):
+        """
+        Looks up the hls url of the stream using the streamlink api (fetches access token and master playlist).
+        """
+        streams = self.create_session().streams("twitch.tv/" + self.username)
+        stream = streams.get(self.quality)
+        if stream is None:
+            return None, None
+
+        # the master playlist url has the access token which tells when the url expires
+        multivariant = getattr(stream, 'multivariant', None)
+        token_url = getattr(multivariant, 'uri', None) or getattr(stream, 'url_master', None)
+        return stream.url, token_url
+
+    async def get_stream_url(self):
+        if self.url_cache is None:
+            return None
+
+        url = self.url_cache.get(self.username)
+        if url is not None:
+            self.used_cached_url = True
+            return url
+
+        try:
+            url, token_url = await asyncio.get_running_loop().run_in_executor(None, self.resolve_stream_url)
+        except Exception as e:
+            log.error(f"failed to resolve stream url: {e}")
+            return None
+
+        if url is not None:
+            self.url_cache.set(self.username, url, token_url)
+
+        return url
 
-    async def record(self, length):
+    def get_output_filename(self):
         filename = self.username + " - " + datetime.datetime.now().strftime("%Y-%m-%d %Hh%Mm%Ss") + ".mp4"
         
         # clean filename from unecessary characters
         filename = "".join(x for x in filename if x.isalnum() or x in [" ", "-", "_", "."])
         
-        recorded_filename = os.path.join(self.recorded_path, filename)
+        return os.path.join(self.recorded_path, filename)
+
+    def save_buffered_sample(self, length):
+        """
+        Writes the last `length` seconds of the stream buffer to a file.
+        Returns None if the buffer is not running or does not have enough audio yet.
+        """
+        if self.stream_buffer is None or not self.stream_buffer.is_running:
+            return None
+
+        if self.stream_buffer.get_buffered_seconds() < length:
+            log.info("stream buffer does not have enough audio yet ...")
+            return None
+
+        # output pauses during ad breaks (ads are filtered) so make sure the buffer is still being filled
+        since_received = self.stream_buffer.get_seconds_since_received()
+        if since_received is None or since_received > BUFFER_STALE_SECONDS:
+            log.warning(f"stream buffer has not received anything for {since_received or 0:.0f} seconds (ad break?). recording instead ...")
+            return None
+
+        data = self.stream_buffer.get_sample(length)
+        expected_bytes = length * self.bytes_per_second
+
+        # gaps (paused output) or far too much data (not audio only) get the checks of a normal recording instead
+        if len(data) < expected_bytes * MIN_BUFFER_FILL or len(data) > expected_bytes * MAX_RATE_FACTOR:
+            log.warning(f"buffered sample has {len(data)} bytes but about {expected_bytes:.0f} were expected. recording instead ...")
+            return None
+
+        recorded_filename = self.get_output_filename()
+        log.info("output path (buffered): " + recorded_filename)
+
+        with open(recorded_filename, 'wb') as f:
+            f.write(data)
+
+        self.sample_store.add(recorded_filename)
+        return recorded_filename
+
+    async def record(self, length, checkpoints=(), on_checkpoint=None):
+        """
+        Records `length` seconds of the stream and returns the path of the recording.
+        When on_checkpoint is given it is called with a copy of the recording so far each time one
+        of the checkpoints (in seconds) is reached, so a short prefix can be identified while the
+        rest is still recording.
+        """
+        self.is_blocked = False
+        self.last_status = RecordingStatus.HEALTHY
+
+        # take sample from the in-memory buffer when available (file io is kept off the event loop)
+        loop = asyncio.get_running_loop()
+        recorded_filename = await loop.run_in_executor(None, self.save_buffered_sample, length)
+        self.used_buffer = recorded_filename is not None
+        if recorded_filename is not None:
+            return recorded_filename
+
+        recorded_filename = self.get_output_filename()
         
         log.info("output path: " + recorded_filename)
 
         self.is_recording = True
-        self.is_blocked = False
+        self.last_status = None
 
-        # start streamlink process
-        cmds = ["streamlink", "twitch.tv/" + self.username, self.quality, "-o", recorded_filename, "--http-header", "Authorization=Bearer " + self.oauth_token, "--http-header", "Client-Id=" + self.client_id, "--http-header", "Origin=https://www.twitch.tv", "--twitch-disable-ads"]
-        print(cmds)
-        p = subprocess.Popen(cmds, shell=False, stdin=None, stdout=None, stderr=None, close_fds=True)
-        
-        sleep_time = 5 + length # add 5 for the initial startup of the process and loading the stream
-        slept = 0
-        last_size = 0
-
-        while slept < sleep_time:
-            await asyncio.sleep(1)
-            slept += 1
-            if os.path.exists(recorded_filename):
-                if os.path.getsize(recorded_filename) > last_size:
-                    last_size = os.path.getsize(recorded_filename)
-                    log.debug(last_size)
-
-                if last_size > SIZE_THRESHOLD: 
-                    self.is_blocked = True
+        # start streamlink process and read the stream from its stdout
+        self.used_cached_url = False
+        stream_url = await self.get_stream_url()
+
+        if stream_url is not None:
+            # already resolved so the twitch plugin (token + master playlist lookup) is skipped.
+            # the generic hls stream does not filter ads or log ad breaks (see streamUrlCacheSeconds in the README)
+            cmds = ["streamlink", "hls://" + stream_url, "best", "--stdout", "--http-header", "Origin=https://www.twitch.tv"]
+        else:
+            cmds = ["streamlink", "twitch.tv/" + self.username, self.quality, "--stdout", "--http-header", "Authorization=Bearer " + self.oauth_token, "--http-header", "Client-Id=" + self.client_id, "--http-header", "Origin=https://www.twitch.tv", "--twitch-disable-ads"]
+        log.debug(cmds)
+        p = await asyncio.create_subprocess_exec(*cmds, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stderr_task = asyncio.create_task(self.watch_stderr(p))
+
+        target_bytes = int(length * self.bytes_per_second)
+        started = time.monotonic()
+        deadline = started + STARTUP_SECONDS + length # give up after this even if target is not reached
+        first_byte_deadline = started + STARTUP_SECONDS + PROBE_SECONDS
+        first_byte_time = None
+        is_probed = False
+        total_bytes = 0
+        f = None
+        checkpoints = sorted(c for c in checkpoints if c < length) if on_checkpoint is not None else []
+        is_cancelled = False
+
+        try:
+            while total_bytes < target_bytes and self.last_status is None:
+                now = time.monotonic()
+                remaining = (deadline if first_byte_time is not None else first_byte_deadline) - now
+                if remaining <= 0:
+                    log.info(f"recording timed out after receiving {total_bytes} bytes")
+                    break
+
+                try:
+                    data = await asyncio.wait_for(p.stdout.read(READ_CHUNK_SIZE), timeout=remaining)
+                except asyncio.TimeoutError:
+                    log.info(f"recording timed out after receiving {total_bytes} bytes")
+                    break
+
+                if not data:
+                    break # streamlink exited
+
+                if f is None:
+                    f = open(recorded_filename, 'wb')
+                    first_byte_time = time.monotonic()
+
+                f.write(data)
+                total_bytes += len(data)
+                log.debug(total_bytes)
+
+                # check the initial byte rate once the probe window has passed
+                if not is_probed and time.monotonic() - first_byte_time >= PROBE_SECONDS:
+                    is_probed = True
+                    if total_bytes > self.get_max_probe_bytes(time.monotonic() - first_byte_time):
+                        log.warning(f"received {total_bytes} bytes in the first {PROBE_SECONDS}s which is too much for audio only")
+                        self.last_status = RecordingStatus.BLOCKED
+
+                if total_bytes > SIZE_THRESHOLD:
+                    self.last_status = RecordingStatus.BLOCKED
                     break # stop recording after filesize limit reached
-        
-        log.info('\n\nkilling streamlink ...')
-        p.kill()
-        p.wait()
 
+                # only hand out a prefix once the probe says the recording looks healthy
+                if len(checkpoints) > 0 and is_probed and self.last_status is None and total_bytes >= checkpoints[0] * self.bytes_per_second:
+                    f.flush()
+                    on_checkpoint(self.save_prefix(recorded_filename, checkpoints.pop(0)))
+        except asyncio.CancelledError:
+            is_cancelled = True # e.g. a prefix was already identified
+            raise
+        finally:
+            if f is not None:
+                f.close()
+
+            log.info('killing streamlink ...')
+            if p.returncode is None:
+                try:
+                    p.kill()
+                except ProcessLookupError:
+                    pass # already exited
+            await p.wait()
+            await stderr_task
+
+            if is_cancelled:
+                log.info(f"recording cancelled after receiving {total_bytes} bytes")
+                await loop.run_in_executor(None, self.sample_store.add, recorded_filename)
+                self.is_recording = False
+
+        if self.last_status is None:
+            if total_bytes == 0:
+                # nothing was downloaded so either streamlink failed or the stream is not being served
+                log.warning(f"no data recorded (streamlink exit code: {p.returncode})")
+                self.last_status = RecordingStatus.BLOCKED
+            else:
+                self.last_status = RecordingStatus.HEALTHY
+
+        if self.used_cached_url and self.last_status != RecordingStatus.HEALTHY:
+            self.url_cache.invalidate(self.username) # resolve again on the next recording
+
+        log.info(f"recording status: {self.last_status}")
+        await loop.run_in_executor(None, self.sample_store.add, recorded_filename)
+        self.is_blocked = self.last_status == RecordingStatus.BLOCKED
         self.is_recording = False
         return recorded_filename
 
+    def save_prefix(self, recorded_filename, seconds):
+        """
+        Copies the recording so far to a separate file (not kept in the sample store).
+        """
+        name, ext = os.path.splitext(recorded_filename)
+        prefix_filename = f"{name} ({seconds}s){ext}"
+        shutil.copyfile(recorded_filename, prefix_filename)
+        log.info(f"recorded {seconds}s prefix: {prefix_filename}")
+        return prefix_filename
+
+    def get_max_probe_bytes(self, elapsed):
+        # streamlink starts a few segments behind live so the first seconds arrive faster than realtime
+        return (elapsed + LIVE_EDGE_SECONDS) * self.bytes_per_second * MAX_RATE_FACTOR
+
+    async def watch_stderr(self, p):
+        """
+        Reads streamlink log messages and kills the process as soon as one shows the recording can not succeed.
+        """
+        while True:
+            line = await p.stderr.readline()
+            if not line:
+                break
+
+            msg = line.decode('utf-8', errors='replace').strip()
+            log.debug(f"[streamlink] {msg}")
+
+            if self.url_cache is not None and any(m in msg.lower() for m in STALE_URL_MESSAGES):
+                self.url_cache.invalidate(self.username)
+
+            status = classify_streamlink_message(msg)
+            if status is not None and self.last_status is None:
+                log.warning(f"recording {status}: {msg}")
+                self.last_status = status
+                if p.returncode is None:
+                    try:
+                        p.kill()
+                    except ProcessLookupError:
+                        pass
+
 
 async def sample_record():
     config = {}
@@ -144,9 +622,9 @@ async def sample_record():
         config = json.load(f)
 
     twitch_recorder = TwitchRecorder(config['botClientID'], config['botSecret'], config['channel'], config['recordedSavePath'])
-    twitch_recorder.authorize(config['botToken']['oauthToken'], config['botToken']['expirationDate'])
+    await twitch_recorder.authorize(config['botToken']['oauthToken'], config['botToken']['expirationDate'])
 
-    stream = twitch_recorder.get_user()
+    stream = await twitch_recorder.get_user()
 
     print(stream)
 
@@ -154,6 +632,7 @@ async def sample_record():
         path = await twitch_recorder.record(20)
 
     print("is_blocked: {0}".format(twitch_recorder.is_blocked))
+    await twitch_recorder.close()
 
 async def sample_record_with_vpn():
     config = {}
@@ -162,20 +641,21 @@ async def sample_record_with_vpn():
         config = json.load(f)
 
     twitch_recorder = TwitchRecorder(config['botClientID'], config['botSecret'], config['channel'], config['recordedSavePath'])
-    twitch_recorder.authorize(config['botToken']['oauthToken'], config['botToken']['expirationDate'])
+    await twitch_recorder.authorize(config['botToken']['oauthToken'], config['botToken']['expirationDate'])
 
     vpn = VpnRotator(config['vpnConfigFolders'], config['vpnUserPwdConfigPath'])
     vpn.connect_random()
 
     await asyncio.sleep(7) # wait for vpn to full init/connect
 
-    stream = twitch_recorder.get_user()
+    stream = await twitch_recorder.get_user()
     print(stream)
 
     if stream is not None:
         path = await twitch_recorder.record(20)
 
     print("is_blocked: {0}".format(twitch_recorder.is_blocked))
+    await twitch_recorder.close()
 
 if __name__ == "__main__":
     asyncio.run(sample_record())
\ No newline at end of file
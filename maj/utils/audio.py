@@ -0,0 +1,122 @@
+import os
+import wave
+import subprocess
+import logging
+import numpy as np
+from maj.samplestore import CODECS
+
+log = logging.getLogger(__name__)
+
+ACR_SAMPLE_RATE = 8000 # ACR fingerprints mono 8kHz audio so anything more is wasted upload
+FRAME_MS = 50 # frame length used when looking for silence
+
+
+def decode_pcm(sample, sample_rate=ACR_SAMPLE_RATE, max_seconds=None):
+    """
+    Decodes an audio file (path or bytes) to mono 16-bit pcm at sample_rate using ffmpeg.
+    """
+    is_bytes = isinstance(sample, (bytes, bytearray))
+
+    cmds = ["ffmpeg", "-loglevel", "error", "-i", "-" if is_bytes else sample, "-vn", "-ac", "1", "-ar", str(sample_rate)]
+    if max_seconds is not None:
+        cmds += ["-t", str(max_seconds)]
+    cmds += ["-f", "s16le", "-"]
+
+    if is_bytes:
+        result = subprocess.run(cmds, check=True, input=bytes(sample), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    else:
+        result = subprocess.run(cmds, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return np.frombuffer(result.stdout, dtype=np.int16)
+
+
+def write_wav(path, pcm, sample_rate):
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(pcm.astype(np.int16).tobytes())
+
+
+def encode_pcm(path, pcm, sample_rate, codec):
+    """
+    Encodes mono 16-bit pcm to path with one of the sample store CODECS using ffmpeg.
+    """
+    encoder, ext, bitrate = CODECS[codec]
+    cmds = ["ffmpeg", "-y", "-loglevel", "error", "-f", "s16le", "-ar", str(sample_rate), "-ac", "1", "-i", "-",
+            "-c:a", encoder, "-b:a", bitrate, path]
+    subprocess.run(cmds, check=True, input=pcm.astype(np.int16).tobytes(), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def get_frame_db(pcm, sample_rate, frame_ms=FRAME_MS):
+    """
+    Returns the loudness (dBFS) of each frame in pcm.
+    """
+    frame_len = max(1, int(sample_rate * frame_ms / 1000))
+    num_frames = len(pcm) // frame_len
+    if num_frames == 0:
+        return np.array([])
+
+    frames = pcm[:num_frames * frame_len].reshape(num_frames, frame_len).astype(np.float32) / 32768.0
+    rms = np.sqrt(np.mean(frames ** 2, axis=1))
+    return 20 * np.log10(rms + 1e-10)
+
+
+def trim_leading_silence(pcm, sample_rate, threshold_db=-45, frame_ms=FRAME_MS):
+    frame_db = get_frame_db(pcm, sample_rate, frame_ms)
+    loud = np.nonzero(frame_db > threshold_db)[0]
+
+    if len(loud) == 0:
+        return pcm # all silence so leave it to ACR to decide
+
+    start = loud[0] * int(sample_rate * frame_ms / 1000)
+    return pcm[start:]
+
+
+class SamplePreprocessor:
+    """
+    Shrinks a recorded sample before it is sent to ACR: mono, downsampled,
+    leading silence trimmed, capped at max_seconds and encoded with `codec`
+    (8kHz pcm is about as big as the audio_only stream so most of the saving is the encoding).
+    """
+
+    def __init__(self, sample_rate=ACR_SAMPLE_RATE, max_seconds=12, skip_seconds=0, trim_silence=True, silence_db=-45, codec='opus'):
+        self.sample_rate = sample_rate
+        self.codec = codec if codec in CODECS else None # None = uncompressed .wav
+        self.max_seconds = max_seconds
+        self.skip_seconds = skip_seconds # drop the start of the recording (e.g. tail end of an ad)
+        self.trim_silence = trim_silence
+        self.silence_db = silence_db
+
+    def process(self, path):
+        """
+        Writes the processed sample next to the original and returns its path.
+        """
+        pcm = decode_pcm(path, self.sample_rate)
+        pcm = pcm[int(self.skip_seconds * self.sample_rate):]
+
+        if self.trim_silence:
+            pcm = trim_leading_silence(pcm, self.sample_rate, self.silence_db)
+
+        pcm = pcm[:int(self.max_seconds * self.sample_rate)]
+
+        if len(pcm) < self.sample_rate:
+            log.warning("less than 1 second of audio left after preprocessing. using original sample")
+            return path
+
+        out_path = None
+        if self.codec is not None:
+            out_path = os.path.splitext(path)[0] + '.acr' + CODECS[self.codec][1]
+            try:
+                encode_pcm(out_path, pcm, self.sample_rate, self.codec)
+            except Exception as e:
+                log.error(f"failed to encode sample as {self.codec}: {e}. sending wav instead")
+                if os.path.exists(out_path):
+                    os.remove(out_path)
+                out_path = None
+
+        if out_path is None:
+            out_path = os.path.splitext(path)[0] + '.acr.wav'
+            write_wav(out_path, pcm, self.sample_rate)
+
+        log.debug(f"preprocessed {os.path.getsize(path)} bytes -> {os.path.getsize(out_path)} bytes")
+        return out_path
@@ -36,17 +36,6 @@ CANT_RECORD_REPLYS = ["I had trouble listening. Please try again ...",
                       "Could you try again please? I'm not sure I heard that.",
                       "Failed to record the stream. Please try again ..."]
 
-ALREADY_IDENTIFYING_REPLYS = ["Gimme a second, I'm still trying to listen.",
-                              "I'm always listening, sometimes I just don't know yet!",
-                              "I'm trying my best to look up this song...",
-                              "I'm trying to figure it out. If you know it then use !add song_title;artist_name",
-                              "I'm hearing the song but still trying to identify!",
-                              "I'm no Shazam - give me a minute!",
-                              "Hold on... I'm trying here!",
-                              "Have faith I'm still trying ...",
-                              "I'll figure it out one day ..."
-                              "I'm already trying to identify!"]
-
 WELCOME_GREETINGS = ["Welcome {0} to {1}!"
                     ,"Hey there {0}! Thanks for joining {1}!"
                     ,"Hey hey hey {0} is in the house! Welcome to {1}!"
@@ -109,8 +98,12 @@ def get_trouble_listening_reply():
     return CANT_RECORD_REPLYS[random.randint(0, len(CANT_RECORD_REPLYS) - 1)]
 
 
-def get_already_listening_reply():
-    return ALREADY_IDENTIFYING_REPLYS[random.randint(0, len(ALREADY_IDENTIFYING_REPLYS) - 1)]
+def get_mentions(names, max_names=10):
+    # '@a @b @c' (plus how many more) so everyone who asked sees the reply
+    mentions = " ".join(f"@{n}" for n in names[:max_names])
+    if len(names) > max_names:
+        mentions += f" (+{len(names) - max_names} more)"
+    return mentions
 
 def get_welcome_greeting(person, day):
     return WELCOME_GREETINGS[random.randint(0, len(WELCOME_GREETINGS) - 1)].format(person, day)
@@ -0,0 +1,77 @@
+import time
+import asyncio
+import logging
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+HELIX_URL = 'https://api.twitch.tv/helix'
+TOKEN_URL = 'https://id.twitch.tv/oauth2/token'
+MAX_RATELIMIT_WAIT = 60 # never wait longer than this for the rate limit to reset
+
+
+class HelixClient:
+    """
+    Async client for the Twitch Helix api that reuses pooled (keep-alive) connections
+    so api calls made from the bot do not block chat handling.
+    """
+
+    def __init__(self, client_id, timeout=10, max_retries=3, pool_size=10):
+        self.client_id = client_id
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.session = None
+
+    def get_session(self):
+        # created lazily because the session has to be created inside the running event loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def request(self, method, url, **kwargs):
+        """
+        Sends the request and returns the json response. Retries when rate limited (429)
+        by waiting until the time in the Ratelimit-Reset header.
+        """
+        for attempt in range(self.max_retries + 1):
+            async with self.get_session().request(method, url, **kwargs) as r:
+                if r.status != 429 or attempt == self.max_retries:
+                    r.raise_for_status()
+                    return await r.json()
+
+                wait = self.get_ratelimit_wait(r.headers, attempt)
+                log.warning(f"twitch api rate limited. retrying in {wait:.1f} seconds ...")
+
+            await asyncio.sleep(wait)
+
+    def get_ratelimit_wait(self, headers, attempt):
+        reset = headers.get('Ratelimit-Reset')
+        if reset is not None:
+            try:
+                return min(MAX_RATELIMIT_WAIT, max(0.0, float(reset) - time.time()))
+            except ValueError:
+                pass
+        return min(MAX_RATELIMIT_WAIT, 2 ** attempt)
+
+    async def get_app_token(self, client_secret):
+        body = {
+            'client_id': self.client_id,
+            'client_secret': client_secret,
+            'grant_type': 'client_credentials'
+        }
+        return await self.request('POST', TOKEN_URL, data=body)
+
+    async def get_streams(self, oauth_token, user_login):
+        headers = {
+            'Client-ID': self.client_id,
+            'Authorization': 'Bearer ' + oauth_token
+        }
+        stream_json = await self.request('GET', HELIX_URL + '/streams', params={'user_login': user_login}, headers=headers)
+        return stream_json.get('data', [])
@@ -10,7 +10,7 @@ from maj.discordbot import MajBotClient
 from maj.twitchrecorder import TwitchRecorder
 from maj.utils.spotifyclient import SpotifyClient
 from maj.utils.botreplys import get_stream_name_by_day
-from bot import logger, config
+from bot import logger, config, archive
 
 if __name__ == "__main__":
 
@@ -20,17 +20,20 @@ if __name__ == "__main__":
     tracks_added = 0
 
     # ensure user has stopped streaming before generating/posting
-    twitch_recorder = TwitchRecorder(config['botClientID'], config['botSecret'], config['channel'], config['recordedSavePath'])
-    twitch_recorder.authorize(config['botToken']['oauthToken'], config['botToken']['expirationDate'])
+    twitch_recorder = TwitchRecorder(config['botClientID'], config['botSecret'], config['channel'], config['recordedSavePath'], status_cache_seconds=config.get('statusCacheSeconds', 60))
+    loop.run_until_complete(twitch_recorder.authorize(config['botToken']['oauthToken'], config['botToken']['expirationDate']))
 
     try:
-        while twitch_recorder.is_user_online():
+        while loop.run_until_complete(twitch_recorder.is_user_online()):
             logger.info('waiting for channel to be offline ...')
             sleep(60)
     except KeyboardInterrupt:
         pass
 
-    playlist = SongList(config['recordedSavePath'], config['channel'], datetime.datetime.today())
+    loop.run_until_complete(twitch_recorder.close())
+
+    # read from the archive when used since the bot writes the setlist json file only when it closes
+    playlist = SongList(config['recordedSavePath'], config['channel'], datetime.datetime.today(), archive=archive)
     day_of_week = playlist.setlist_start.weekday()
 
     # save setlist to a spotify playlist
@@ -75,4 +78,7 @@ if __name__ == "__main__":
         try:
             loop.run_until_complete(discord_bot.close())
         except Exception as e:
-            pass 
\ No newline at end of file
+            pass 
+
+    if archive is not None:
+        archive.close()
@@ -9,9 +9,11 @@ setup(
     author_email='rodriada000@gmail.com',
     packages=find_packages(),
     install_requires=[
+        'aiohttp',
         'asyncio',
         'discord.py',
         'imgkit',
+        'numpy',
         'requests',
         'spotipy',
         'streamlink',